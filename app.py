@@ -1,18 +1,46 @@
 # --- 1. IMPORT NECESSARI ---
 import streamlit as st
+import os
+import io
+import json
+import hashlib
+import urllib.request
+import urllib.error
 import pandas as pd
 import numpy as np
 import folium
-from folium.plugins import Geocoder
-from streamlit_folium import folium_static
+from folium.plugins import MarkerCluster
+from folium.elements import JSCSSMixin
+from branca.element import MacroElement
+from jinja2 import Template
 from datetime import datetime
 import re
+import time
+from functools import cached_property
+from collections import OrderedDict, deque, namedtuple
+import threading
+import contextlib
+import sqlite3
 import plotly.graph_objects as go
+import plotly.io as pio
 from plotly.subplots import make_subplots
 from branca.colormap import linear
 
 # --- 2. CONFIGURAZIONE CENTRALE E FUNZIONI DI BASE ---
-SHEET_URL = "https://docs.google.com/spreadsheets/d/e/2PACX-1vRxitMYpUqvX6bxVaukG01lJDC8SUfXtr47Zv5ekR1IzfR1jmhUilBsxZPJ8hrktVHrBh6hUUWYUtox/pub?output=csv"
+SHEET_URL = os.environ.get("MAPPA_SHEET_URL", "https://docs.google.com/spreadsheets/d/e/2PACX-1vRxitMYpUqvX6bxVaukG01lJDC8SUfXtr47Zv5ekR1IzfR1jmhUilBsxZPJ8hrktVHrBh6hUUWYUtox/pub?output=csv")
+
+# Snapshot locale (Parquet) dell'ultimo dataframe pulito: evita di riscaricare e riparsare tutto lo storico
+SNAPSHOT_DIR = os.environ.get("MAPPA_SNAPSHOT_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), ".snapshot_dati"))
+HTTP_TIMEOUT = 60
+
+# Aggiornamento in background: intervallo tra i ricaricamenti e backoff (minimo, massimo) dopo un errore, in secondi
+REFRESH_INTERVALLO = float(os.environ.get("MAPPA_REFRESH_SECONDI", 3600))
+REFRESH_BACKOFF = (float(os.environ.get("MAPPA_REFRESH_BACKOFF_MIN", 30)), float(os.environ.get("MAPPA_REFRESH_BACKOFF_MAX", 1800)))
+
+# Metriche di runtime: file .json o .sqlite/.db in cui conservarle tra i riavvii (vuoto = solo in memoria)
+# e pannello nella sidebar per gli amministratori
+METRICHE_PATH = os.environ.get("MAPPA_METRICHE_PATH", "")
+METRICHE_ADMIN = os.environ.get("MAPPA_METRICHE_ADMIN", "") == "1"
 
 COLONNE_FILTRO_RIEPILOGO = [
     "LEGENDA_TEMPERATURA_MEDIANA", "LEGENDA_PIOGGE_RESIDUA", "LEGENDA_MEDIA_PORCINI_CALDO_BASE", "LEGENDA_MEDIA_PORCINI_FREDDO_BASE",
@@ -31,69 +59,1087 @@ def check_password():
     if not st.session_state.get("password_correct"): st.stop()
     return False
 
+# --- METRICHE DI RUNTIME (condivise tra sessioni e thread) ---
+CAMPIONI_PER_FASE = 500
+SALVATAGGIO_METRICHE_S = 30
+
+class Metrics:
+    """Contatori, durate per fase (ultime CAMPIONI_PER_FASE, per i percentili) e hit rate delle cache.
+
+    Tutte le modifiche passano da un lock: le sessioni Streamlit e il thread di aggiornamento scrivono in parallelo.
+    Con un percorso lo stato viene riletto all'avvio e salvato al più ogni SALVATAGGIO_METRICHE_S secondi.
+    """
+    def __init__(self, percorso=METRICHE_PATH):
+        self.percorso = percorso
+        self._lock = threading.Lock()
+        self.contatori, self.durate, self.cache = {}, {}, {}
+        self._ultimo_salvataggio = time.monotonic()
+        if percorso: self._load()
+
+    def increment(self, nome, n=1):
+        with self._lock:
+            self.contatori[nome] = valore = self.contatori.get(nome, 0) + n
+        self._save_if_due()
+        return valore
+
+    def counter(self, nome):
+        with self._lock: return self.contatori.get(nome, 0)
+
+    def record(self, fase, secondi):
+        with self._lock:
+            if fase not in self.durate: self.durate[fase] = [0, deque(maxlen=CAMPIONI_PER_FASE)]
+            self.durate[fase][0] += 1; self.durate[fase][1].append(secondi)
+        self._save_if_due()
+
+    @contextlib.contextmanager
+    def timer(self, fase):
+        inizio = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(fase, time.perf_counter() - inizio)
+
+    def cache_lookup(self, nome):
+        with self._lock:
+            richieste, mancate = self.cache.get(nome, (0, 0))
+            self.cache[nome] = (richieste + 1, mancate)
+
+    def cache_miss(self, nome):
+        # Chiamato dal costruttore eseguito solo quando la cache non ha il valore: la richiesta è già contata
+        with self._lock:
+            richieste, mancate = self.cache.get(nome, (0, 0))
+            self.cache[nome] = (richieste, mancate + 1)
+
+    def cache_counts(self, nome):
+        # (richieste, miss) di una cache, senza calcolare l'intero snapshot
+        with self._lock: return self.cache.get(nome, (0, 0))
+
+    def snapshot(self):
+        with self._lock:
+            durate = {fase: (n, np.array(campioni)) for fase, (n, campioni) in self.durate.items()}
+            cache, contatori = dict(self.cache), dict(self.contatori)
+        fasi = {}
+        for fase, (n, campioni) in sorted(durate.items()):
+            p50, p90, p99 = np.percentile(campioni, [50, 90, 99]) * 1000 if len(campioni) else (np.nan,) * 3
+            fasi[fase] = {"n": n, "media_ms": float(campioni.mean() * 1000) if len(campioni) else None, "p50_ms": float(p50), "p90_ms": float(p90), "p99_ms": float(p99),
+                          "max_ms": float(campioni.max() * 1000) if len(campioni) else None}
+        return {"contatori": contatori, "fasi": fasi,
+                "cache": {nome: {"richieste": r, "miss": m, "hit_rate": (r - m) / r if r else None} for nome, (r, m) in sorted(cache.items())}}
+
+    def to_json(self):
+        return json.dumps(self.snapshot(), indent=2)
+
+    def _state(self):
+        with self._lock:
+            return {"contatori": dict(self.contatori), "durate": {fase: [n, list(campioni)] for fase, (n, campioni) in self.durate.items()},
+                    "cache": {nome: list(valori) for nome, valori in self.cache.items()}}
+
+    def _load(self):
+        try:
+            if self.percorso.endswith((".sqlite", ".db")):
+                with contextlib.closing(sqlite3.connect(self.percorso)) as conn:
+                    conn.execute("CREATE TABLE IF NOT EXISTS metriche (chiave TEXT PRIMARY KEY, valore TEXT)")
+                    riga = conn.execute("SELECT valore FROM metriche WHERE chiave = 'stato'").fetchone()
+                stato = json.loads(riga[0]) if riga else {}
+            elif os.path.exists(self.percorso):
+                with open(self.percorso, encoding="utf-8") as f: stato = json.load(f)
+            else: stato = {}
+        except (OSError, ValueError, sqlite3.Error):
+            stato = {}  # file illeggibile: si riparte da zero
+        self.contatori = dict(stato.get("contatori", {}))
+        self.durate = {fase: [n, deque(campioni, maxlen=CAMPIONI_PER_FASE)] for fase, (n, campioni) in stato.get("durate", {}).items()}
+        self.cache = {nome: tuple(valori) for nome, valori in stato.get("cache", {}).items()}
+
+    def save(self):
+        if not self.percorso: return
+        stato = json.dumps(self._state())
+        try:
+            if self.percorso.endswith((".sqlite", ".db")):
+                with contextlib.closing(sqlite3.connect(self.percorso)) as conn, conn:
+                    conn.execute("CREATE TABLE IF NOT EXISTS metriche (chiave TEXT PRIMARY KEY, valore TEXT)")
+                    conn.execute("INSERT OR REPLACE INTO metriche (chiave, valore) VALUES ('stato', ?)", (stato,))
+            else:
+                # Come per lo snapshot: file temporaneo + os.replace
+                with open(self.percorso + ".tmp", "w", encoding="utf-8") as f: f.write(stato)
+                os.replace(self.percorso + ".tmp", self.percorso)
+        except (OSError, sqlite3.Error):
+            pass  # le metriche non devono mai far fallire l'app
+
+    def _save_if_due(self):
+        if not self.percorso: return
+        with self._lock:
+            if time.monotonic() - self._ultimo_salvataggio < SALVATAGGIO_METRICHE_S: return
+            self._ultimo_salvataggio = time.monotonic()
+        self.save()
+
+def measure(metriche, fase):
+    # Timer opzionale per le funzioni usabili anche senza metriche (benchmark, script)
+    return metriche.timer(fase) if metriche is not None else contextlib.nullcontext()
+
 @st.cache_resource
-def get_view_counter(): return {"count": 0}
+def get_metrics(): return Metrics()
 
 # --- FUNZIONE DI CARICAMENTO DATI CORRETTA E ROBUSTA ---
-@st.cache_data(ttl=3600)
-def load_and_prepare_data(url: str):
-    load_timestamp = datetime.now().strftime("%d/%m/%Y %H:%M:%S")
+# Schema delle colonne (nomi già puliti). Le colonne non elencate sono misure numeriche.
+SCHEMA_COLONNE = {
+    'DATA': 'date',
+    'CODICE': 'category', 'STAZIONE': 'category', 'LEGENDA_COLORE': 'category', 'LEGENDA_COMUNE': 'category',
+    'LEGENDA_DESCRIZIONE': 'text', 'LEGENDA_ULTIMO_AGGIORNAMENTO_SHEET': 'text', 'LEGENDA_SBALZO_TERMICO_MIGLIORE': 'text', 'LEGENDA_SBALZO_TERMICO_SECONDO': 'text',
+    'PORCINI_CALDO_NOTE': 'text', 'PORCINI_FREDDO_NOTE': 'text', 'SBALZO_TERMICO_MIGLIORE': 'text', '2°_SBALZO_TERMICO_MIGLIORE': 'text', 'LEGENDA': 'text'
+}
+TIPO_NUMERICO = 'float32'
+
+def clean_column_name(col):
+    temp_name = str(col).replace('[', '').replace(']', '').replace('(', '').replace(')', '').replace("'", "")
+    return temp_name.strip().replace(' ', '_').upper()
+
+def read_sheet_csv(contenuto: bytes, skiprows=[1]):
+    # Si legge prima la sola intestazione per tradurre lo schema (nomi puliti) nei nomi grezzi del foglio
+    nomi_grezzi = pd.read_csv(io.BytesIO(contenuto), nrows=0).columns
+    tipi = {}
+    for col in nomi_grezzi:
+        tipo = SCHEMA_COLONNE.get(clean_column_name(col), 'numeric')
+        tipi[col] = 'category' if tipo == 'category' else TIPO_NUMERICO if tipo == 'numeric' else str
+    opzioni = dict(na_values=["#N/D", "#N/A"], header=0, skiprows=skiprows, decimal=',')
     try:
-        df = pd.read_csv(url, na_values=["#N/D", "#N/A"], dtype=str, header=0, skiprows=[1])
-        
-        # Pulizia nomi colonne
-        cleaned_cols = {}
-        for col in df.columns:
-            temp_name = str(col).replace('[', '').replace(']', '').replace('(', '').replace(')', '').replace("'", "")
-            cleaned_name = temp_name.strip().replace(' ', '_').upper()
-            cleaned_cols[col] = cleaned_name
-        df.rename(columns=cleaned_cols, inplace=True)
-        df = df.loc[:, ~df.columns.duplicated()]
-
-        # Gestione sbalzo termico
-        for sbalzo_col, suffisso in [("LEGENDA_SBALZO_TERMICO_MIGLIORE", "MIGLIORE"), ("LEGENDA_SBALZO_TERMICO_SECONDO", "SECONDO")]:
-            if sbalzo_col in df.columns:
-                split_cols = df[sbalzo_col].str.split(' - ', n=1, expand=True)
-                if split_cols.shape[1] == 2: df[f"LEGENDA_SBALZO_NUMERICO_{suffisso}"] = pd.to_numeric(split_cols[0].str.replace(',', '.'), errors='coerce')
-        
-        # MODIFICA: Aggiunto CODICE alla lista delle colonne di testo
-        TEXT_COLUMNS = ['CODICE', 'STAZIONE', 'LEGENDA_DESCRIZIONE', 'LEGENDA_COMUNE', 'LEGENDA_COLORE', 'LEGENDA_ULTIMO_AGGIORNAMENTO_SHEET', 'LEGENDA_SBALZO_TERMICO_MIGLIORE', 'LEGENDA_SBALZO_TERMICO_SECONDO', 'PORCINI_CALDO_NOTE', 'PORCINI_FREDDO_NOTE', 'SBALZO_TERMICO_MIGLIORE', '2°_SBALZO_TERMICO_MIGLIORE', 'LEGENDA']
-
-        # Conversione tipi di dato
-        for col in df.columns:
-            if col.strip().upper() == 'DATA':
-                df[col] = pd.to_datetime(df[col], dayfirst=True, errors='coerce')
-            elif col.strip().upper() not in TEXT_COLUMNS:
-                df[col] = pd.to_numeric(df[col].astype(str).str.replace(',', '.', regex=False), errors='coerce')
-        
-        # Assicuriamoci che le colonne chiave esistano
-        if 'CODICE' not in df.columns or 'STAZIONE' not in df.columns:
-            st.error("ERRORE CRITICO: Le colonne 'Codice' e/o 'Stazione' non sono presenti nel file Google Sheet. L'app non può funzionare.")
-            st.stop()
-            
-        return df, load_timestamp
+        # Un solo passaggio: virgola decimale e tipi finali applicati direttamente dal parser
+        return pd.read_csv(io.BytesIO(contenuto), dtype=tipi, **opzioni)
+    except ValueError:
+        # Qualche cella non numerica in una colonna di misure: le sole colonne sporche vengono convertite a parte
+        numeriche = [col for col, tipo in tipi.items() if tipo == TIPO_NUMERICO]
+        df = pd.read_csv(io.BytesIO(contenuto), dtype={col: tipo for col, tipo in tipi.items() if tipo != TIPO_NUMERICO}, **opzioni)
+        for col in numeriche:
+            if df[col].dtype == object or pd.api.types.is_string_dtype(df[col]):
+                df[col] = pd.to_numeric(df[col].str.replace(',', '.', regex=False), errors='coerce')
+            df[col] = df[col].astype(TIPO_NUMERICO)
+        return df
+
+def parse_sbalzo_values(serie):
+    # "12,5 - 01/10/2025" -> 12.5; i valori distinti sono pochi, quindi si parsano solo quelli
+    codici, valori = pd.factorize(serie)
+    numerici = pd.to_numeric(pd.Series(valori, dtype=str).str.split(' - ', n=1).str[0].str.replace(',', '.', regex=False), errors='coerce').to_numpy(dtype=TIPO_NUMERICO)
+    return pd.Series(np.where(codici >= 0, numerici[codici], np.nan).astype(TIPO_NUMERICO), index=serie.index)
+
+def prepare_dataframe(df):
+    # Pulizia nomi colonne
+    df.rename(columns={col: clean_column_name(col) for col in df.columns}, inplace=True)
+    df = df.loc[:, ~df.columns.duplicated()]
+
+    # Gestione sbalzo termico
+    for sbalzo_col, suffisso in [("LEGENDA_SBALZO_TERMICO_MIGLIORE", "MIGLIORE"), ("LEGENDA_SBALZO_TERMICO_SECONDO", "SECONDO")]:
+        if sbalzo_col in df.columns and df[sbalzo_col].str.contains(' - ', regex=False).any():
+            df[f"LEGENDA_SBALZO_NUMERICO_{suffisso}"] = parse_sbalzo_values(df[sbalzo_col])
+
+    if 'DATA' in df.columns:
+        df['DATA'] = pd.to_datetime(df['DATA'], dayfirst=True, errors='coerce')
+    return df
+
+def concat_frames(df_a, df_b):
+    # pd.concat trasforma in object le categorie con valori diversi: si uniscono esplicitamente
+    df = pd.concat([df_a, df_b], ignore_index=True)
+    for col in df_a.columns.intersection(df_b.columns):
+        if isinstance(df_a[col].dtype, pd.CategoricalDtype) and isinstance(df_b[col].dtype, pd.CategoricalDtype):
+            parti = [df_a[col], df_b[col]]
+            # Una colonna tutta vuota (es. colore non ancora compilato nelle righe nuove) ha categorie di un altro tipo,
+            # che union_categoricals rifiuta: si riportano entrambe a stringhe
+            if parti[0].cat.categories.dtype != parti[1].cat.categories.dtype:
+                parti = [p.cat.rename_categories(p.cat.categories.astype(str)) for p in parti]
+            df[col] = pd.api.types.union_categoricals(parti)
+    return df
+
+def snapshot_paths(url):
+    base = os.path.join(SNAPSHOT_DIR, hashlib.sha1(url.encode("utf-8")).hexdigest()[:16])
+    return base + ".parquet", base + ".json"
+
+def read_snapshot(url):
+    path_dati, path_meta = snapshot_paths(url)
+    if not (os.path.exists(path_dati) and os.path.exists(path_meta)): return None, {}
+    try:
+        with open(path_meta, encoding="utf-8") as f: meta = json.load(f)
+        return pd.read_parquet(path_dati), meta
+    except Exception:
+        # Snapshot illeggibile (es. scrittura interrotta o versione pyarrow diversa): si riparte da zero
+        return None, {}
+
+def write_snapshot(url, df, meta):
+    os.makedirs(SNAPSHOT_DIR, exist_ok=True)
+    path_dati, path_meta = snapshot_paths(url)
+    # Scrittura su file temporanei + os.replace: chi legge vede sempre uno snapshot completo
+    if df is not None:
+        df.to_parquet(path_dati + ".tmp", index=False); os.replace(path_dati + ".tmp", path_dati)
+    with open(path_meta + ".tmp", "w", encoding="utf-8") as f: json.dump(meta, f)
+    os.replace(path_meta + ".tmp", path_meta)
+
+def fetch_source(url, meta):
+    """Scarica il CSV solo se cambiato. Ritorna (contenuto, validatori); contenuto è None se la sorgente non è cambiata.
+
+    Oltre all'URL del foglio pubblicato accetta un percorso locale (o file://), utile per lavorare offline.
+    """
+    if url.startswith("file://"): url = urllib.request.url2pathname(url[len("file://"):])
+    if not re.match(r"^https?://", url):
+        stat = os.stat(url); validatore = f"{stat.st_mtime_ns}-{stat.st_size}"
+        if validatore == meta.get("etag"): return None, {"etag": validatore}
+        with open(url, "rb") as f: return f.read(), {"etag": validatore}
+
+    headers = {}
+    if meta.get("etag"): headers["If-None-Match"] = meta["etag"]
+    if meta.get("last_modified"): headers["If-Modified-Since"] = meta["last_modified"]
+    try:
+        with urllib.request.urlopen(urllib.request.Request(url, headers=headers), timeout=HTTP_TIMEOUT) as resp:
+            return resp.read(), {"etag": resp.headers.get("ETag"), "last_modified": resp.headers.get("Last-Modified")}
+    except urllib.error.HTTPError as e:
+        if e.code == 304: return None, {"etag": meta.get("etag"), "last_modified": meta.get("last_modified")}
+        raise
+
+def load_incremental(url, metriche=None):
+    """Aggiorna lo snapshot locale a partire dalla sorgente e ritorna (df, meta).
+
+    - sorgente invariata (304, stesso validatore o stesso hash): si usa lo snapshot così com'è;
+    - sorgente cresciuta in coda (il vecchio contenuto è un prefisso del nuovo): si parsano solo le righe nuove,
+      con ripiego sul parsing completo se la coda non si riesce a unire allo snapshot;
+    - altrimenti (righe modificate o riordinate): parsing completo.
+    Se la sorgente non è raggiungibile ma esiste uno snapshot, si riparte da quello.
+    """
+    df_snapshot, meta = read_snapshot(url)
+    try:
+        with measure(metriche, "download"):
+            contenuto, validatori = fetch_source(url, meta if df_snapshot is not None else {})
     except Exception as e:
-        st.error(f"Errore critico durante il caricamento dei dati: {e}"); return None, None
+        # L'errore resta nei meta: chi ricarica periodicamente lo conta come tentativo fallito
+        if df_snapshot is not None: return df_snapshot, {**meta, "modalita": "snapshot", "errore": str(e)}
+        raise
+    if contenuto is None:
+        return df_snapshot, {**meta, "modalita": "snapshot"}
+
+    digest = hashlib.sha256(contenuto).hexdigest()
+    if df_snapshot is not None and digest == meta.get("sha256"):
+        meta = {**meta, **validatori, "modalita": "snapshot"}
+        try:
+            write_snapshot(url, None, meta)
+        except OSError:
+            pass  # filesystem in sola lettura o pieno: lo snapshot resta valido, si perdono solo i nuovi validatori
+        return df_snapshot, meta
+
+    lunghezza_prec = meta.get("lunghezza", 0)
+    # La coda deve iniziare su un confine di riga, altrimenti l'ultima riga del vecchio contenuto è stata modificata
+    cresciuto_in_coda = (
+        df_snapshot is not None and 0 < lunghezza_prec < len(contenuto)
+        and (contenuto[lunghezza_prec - 1:lunghezza_prec] == b"\n" or contenuto[lunghezza_prec:lunghezza_prec + 1] in (b"\r", b"\n"))
+        and hashlib.sha256(contenuto[:lunghezza_prec]).hexdigest() == meta.get("sha256")
+    )
+    df = None
+    if cresciuto_in_coda:
+        intestazione = contenuto.split(b"\n", 1)[0].rstrip(b"\r")
+        try:
+            with measure(metriche, "parsing"):
+                df_nuove = prepare_dataframe(read_sheet_csv(intestazione + b"\n" + contenuto[lunghezza_prec:], skiprows=None))
+                df = concat_frames(df_snapshot, df_nuove)
+            modalita = "incrementale"
+        except Exception:
+            df = None  # coda non unibile allo snapshot: si ripiega sul parsing completo
+    if df is None:
+        with measure(metriche, "parsing"):
+            df = prepare_dataframe(read_sheet_csv(contenuto))
+        modalita = "completo"
+
+    meta = {**validatori, "sha256": digest, "lunghezza": len(contenuto), "righe": len(df), "modalita": modalita,
+            "caricato_il": datetime.now().strftime("%d/%m/%Y %H:%M:%S")}
+    try:
+        write_snapshot(url, df, meta)
+    except OSError:
+        pass  # filesystem in sola lettura: si lavora comunque in memoria
+    return df, meta
+
+def load_and_prepare_data(url: str, metriche=None):
+    # Niente chiamate st qui: la funzione gira nel thread di aggiornamento, gli errori risalgono come eccezioni
+    df, meta = load_incremental(url, metriche)
+
+    # Assicuriamoci che le colonne chiave esistano
+    if 'CODICE' not in df.columns or 'STAZIONE' not in df.columns:
+        raise ValueError("Le colonne 'Codice' e/o 'Stazione' non sono presenti nel file Google Sheet. L'app non può funzionare.")
+    return df, meta
+
+# --- INDICI DI ACCESSO AI DATI (costruiti una volta per caricamento) ---
+class DataIndex:
+    """Layout del dataframe ordinato per data, con offset per giorno e righe per stazione.
+
+    Ogni vista estrae il proprio sottoinsieme in O(risultato) invece di scandire tutto lo storico a ogni rerun.
+    """
+    def __init__(self, df, versione=None):
+        # Si conserva solo la copia ordinata: ogni versione servita tiene in memoria un solo dataframe
+        self.versione = versione
+        # Righe ordinate per data (stabile: a parità di data resta l'ordine del foglio), date mancanti in coda
+        self.df_ordinato = df.sort_values('DATA', kind='stable', na_position='last').reset_index(drop=True)
+        n_validi = int(self.df_ordinato['DATA'].notna().sum())
+        self.date = self.df_ordinato['DATA'].to_numpy()[:n_validi]
+        self.giorni, inizi = np.unique(self.date, return_index=True)
+        self.offset_giorni = np.append(inizi, n_validi)
+
+        # Per ogni stazione, intervallo in un vettore di posizioni ordinate per stazione e poi per data
+        self.codici_righe, self.codici_stazioni = pd.factorize(self.df_ordinato['CODICE'])
+        self.ordine_stazioni = np.argsort(self.codici_righe, kind='stable')
+        confini = np.searchsorted(self.codici_righe[self.ordine_stazioni], np.arange(len(self.codici_stazioni) + 1))
+        self.intervalli_stazioni = {codice: (confini[i], confini[i + 1]) for i, codice in enumerate(self.codici_stazioni)}
+
+        self.ultima_data = pd.Timestamp(self.giorni[-1]) if len(self.giorni) else None
+        self.df_ultimo = self.df_ordinato.iloc[self.offset_giorni[-2]:self.offset_giorni[-1]] if len(self.giorni) else self.df_ordinato.iloc[0:0]
+
+    @property
+    def prima_data(self):
+        return pd.Timestamp(self.giorni[0]) if len(self.giorni) else None
+
+    def station_rows(self, station_code):
+        inizio, fine = self.intervalli_stazioni.get(station_code, (0, 0))
+        return self.df_ordinato.take(self.ordine_stazioni[inizio:fine])
+
+    @cached_property
+    def anagrafica(self):
+        # Una riga per stazione (ordine di codici_stazioni) con il primo valore non nullo, come 'first' nel groupby
+        colonne_fisse = [c for c in ['STAZIONE', 'LATITUDINE', 'LONGITUDINE'] if c in self.df_ordinato.columns]
+        return (self.df_ordinato.iloc[:len(self.date)].groupby('CODICE', observed=True, sort=False)[colonne_fisse].first()
+                .reindex(pd.Index(self.codici_stazioni, name='CODICE')).reset_index())
+
+    @cached_property
+    def cubo(self):
+        return PeriodCube(self)
+
+    @cached_property
+    def filtri(self):
+        return FilterEngine(self)
+
+    @cached_property
+    def anagrafica_geo(self):
+        return self.anagrafica.dropna(subset=['LATITUDINE', 'LONGITUDINE']).reset_index(drop=True)
+
+    @cached_property
+    def spaziale(self):
+        # Indice spaziale sulle stazioni con coordinate valide: le posizioni restituite sono righe di anagrafica_geo
+        return SpatialIndex(self.anagrafica_geo['LATITUDINE'], self.anagrafica_geo['LONGITUDINE'])
+
+    def precompute(self):
+        # Strutture usate a ogni rerun, costruite prima che questa versione dei dati venga servita
+        for nome in ['cubo', 'filtri'] + (['spaziale'] if {'LATITUDINE', 'LONGITUDINE'} <= set(self.df_ordinato.columns) else []):
+            getattr(self, nome)
+
+    def nearest_stations(self, lat, lon, n=5, escludi=None):
+        posizioni, distanze = self.spaziale.nearest(lat, lon, n + (escludi is not None))
+        vicine = self.anagrafica_geo.iloc[posizioni].assign(DISTANZA_KM=distanze)
+        return vicine[vicine['CODICE'] != escludi].head(n) if escludi is not None else vicine
+
+# Colonne aggregate nell'analisi di periodo: colonna sorgente -> (colonna risultato, somma o media)
+COLONNE_CUBO = {'TOTALE_PIOGGIA_GIORNO': ('TOTALE_PIOGGIA_GIORNO', 'sum'), 'TEMP_MAX': ('MEDIA_TEMP_MAX', 'mean'), 'TEMP_MIN': ('MEDIA_TEMP_MIN', 'mean'), 'TEMPERATURA_MEDIANA': ('MEDIA_TEMP_MEDIANA', 'mean')}
+
+class PeriodCube:
+    """Somme e conteggi cumulativi per stazione x giorno (array NumPy stazioni x (giorni + 1)).
+
+    La somma (o la media) di un qualsiasi intervallo di date è la differenza tra due colonne del cubo,
+    quindi il costo non dipende dalla lunghezza del periodo. I NaN sono esclusi come in pandas:
+    somma 0 e media NaN per una stazione senza valori nel periodo (somma NaN con solo_misurate=True).
+
+    Memoria: 8 byte per cella per ogni colonna di COLONNE_CUBO (somme float64) più 4 byte per cella per i
+    conteggi delle righe e per ogni distribuzione di NaN distinta tra le colonne (conteggi int32,
+    condivisi tra colonne con gli stessi NaN). Con 1000 stazioni x 10 anni una cella vale 1000 x 3651:
+    ~117 MB di somme e 15-73 MB di conteggi; vedi nbytes.
+    """
+    def __init__(self, indice):
+        self.indice = indice
+        n_stazioni, n_giorni = len(indice.codici_stazioni), len(indice.giorni)
+        n_validi = len(indice.date)
+        codici = indice.codici_righe[:n_validi]
+        giorno_righe = np.repeat(np.arange(n_giorni), np.diff(indice.offset_giorni))
+        valide = codici >= 0
+        cella = codici[valide] * n_giorni + giorno_righe[valide]
+
+        def cumulata(celle, pesi=None):
+            totali = np.bincount(celle, weights=pesi, minlength=n_stazioni * n_giorni).reshape(n_stazioni, n_giorni)
+            cumulato = np.zeros((n_stazioni, n_giorni + 1), dtype=np.float64 if pesi is not None else np.int32)
+            np.cumsum(totali, axis=1, out=cumulato[:, 1:])
+            return cumulato
+
+        self.righe = cumulata(cella)
+        self.somme, self.conteggi = {}, {}
+        maschere = []  # (righe presenti, conteggi) già calcolati: le colonne con gli stessi NaN condividono l'array
+        for col in COLONNE_CUBO:
+            if col not in indice.df_ordinato.columns: continue
+            valori = indice.df_ordinato[col].to_numpy(dtype=np.float64, na_value=np.nan)[:n_validi][valide]
+            presenti = ~np.isnan(valori)
+            self.somme[col] = cumulata(cella[presenti], valori[presenti])
+            # Conteggi dei valori presenti (medie e stazioni senza misure); senza NaN coincidono con quelli delle righe
+            if presenti.all():
+                self.conteggi[col] = self.righe; continue
+            conteggi = next((c for m, c in maschere if np.array_equal(m, presenti)), None)
+            if conteggi is None:
+                conteggi = cumulata(cella[presenti]); maschere.append((presenti, conteggi))
+            self.conteggi[col] = conteggi
+
+        self.stazioni = indice.anagrafica
+
+    @property
+    def nbytes(self):
+        array = {id(a): a for a in [self.righe, *self.somme.values(), *self.conteggi.values()]}
+        return sum(a.nbytes for a in array.values())
+
+    def aggregate(self, start_date, end_date, solo_misurate=False):
+        # solo_misurate: somma NaN (non 0) per le stazioni senza nessun valore della colonna nel periodo
+        giorni = self.indice.giorni
+        inizio = np.searchsorted(giorni, pd.Timestamp(start_date).to_datetime64(), side='left')
+        fine = np.searchsorted(giorni, (pd.Timestamp(end_date) + pd.Timedelta(days=1)).to_datetime64(), side='left')
+        # Come nel groupby, compaiono solo le stazioni con almeno una riga nel periodo
+        presenti = (self.righe[:, fine] - self.righe[:, inizio]) > 0
+        df_agg = self.stazioni[presenti].copy()
+        for col, (col_risultato, funzione) in COLONNE_CUBO.items():
+            if col not in self.somme:
+                df_agg[col_risultato] = np.nan; continue
+            somme = (self.somme[col][:, fine] - self.somme[col][:, inizio])[presenti]
+            conteggi = (self.conteggi[col][:, fine] - self.conteggi[col][:, inizio])[presenti]
+            if funzione == 'sum':
+                df_agg[col_risultato] = np.where(conteggi > 0, somme, np.nan) if solo_misurate else somme
+            else:
+                with np.errstate(invalid='ignore', divide='ignore'):
+                    df_agg[col_risultato] = np.where(conteggi > 0, somme / conteggi, np.nan)
+        colonne = ['CODICE', 'STAZIONE', 'TOTALE_PIOGGIA_GIORNO', 'LATITUDINE', 'LONGITUDINE', 'MEDIA_TEMP_MAX', 'MEDIA_TEMP_MIN', 'MEDIA_TEMP_MEDIANA']
+        return df_agg.reindex(columns=colonne).sort_values('CODICE').reset_index(drop=True)
+
+# Slider della mappa riepilogativa: colonne standard seguite dagli sbalzi termici
+COLONNE_SBALZO_FILTRO = [("LEGENDA_SBALZO_NUMERICO_MIGLIORE", "Migliore"), ("LEGENDA_SBALZO_NUMERICO_SECONDO", "Secondo")]
+
+class FilterEngine:
+    """Statistiche dei filtri e maschera vettoriale sull'ultima fotografia delle stazioni.
+
+    I massimi storici degli slider e la matrice (stazioni x colonne) dei valori più recenti sono calcolati
+    una volta per caricamento; a ogni rerun tutti i range attivi sono valutati in un solo passaggio NumPy
+    e i filtri lasciati a tutto campo non costano nulla.
+    """
+    def __init__(self, indice):
+        colonne = COLONNE_FILTRO_RIEPILOGO + [col for col, _ in COLONNE_SBALZO_FILTRO]
+        # Massimo storico per gli slider, solo per le colonne con almeno un valore numerico
+        self.massimi = {}
+        for col in colonne:
+            if col not in indice.df_ordinato.columns: continue
+            valori = pd.to_numeric(indice.df_ordinato[col], errors='coerce')
+            if valori.notna().any(): self.massimi[col] = float(valori.max())
+        self.colonne = list(self.massimi)
+        self.posizioni = {col: i for i, col in enumerate(self.colonne)}
+
+        # Valori dell'ultimo giorno, NaN -> 0 come nel filtro originale; il dtype resta quello delle colonne
+        # (float32) perché il confronto con gli estremi degli slider dia gli stessi risultati di Series.between
+        df_ultimo = indice.df_ultimo
+        serie = [pd.to_numeric(df_ultimo[col], errors='coerce').fillna(0) for col in self.colonne]
+        dtype = np.result_type(*[s.dtype for s in serie]) if serie else np.float64
+        self.valori = np.empty((len(df_ultimo), len(serie)), dtype=dtype)
+        for i, s in enumerate(serie): self.valori[:, i] = s.to_numpy(dtype=dtype)
+        self.minimi_ultimo = self.valori.min(axis=0) if len(df_ultimo) else np.zeros(len(serie), dtype=dtype)
+        self.massimi_ultimo = self.valori.max(axis=0) if len(df_ultimo) else np.zeros(len(serie), dtype=dtype)
+
+    def mask(self, selezioni):
+        tipo = self.valori.dtype.type
+        indici, minimi, massimi = [], [], []
+        for col, (lo, hi) in selezioni.items():
+            i = self.posizioni.get(col)
+            # Fast path: un range che copre tutti i valori dell'ultimo giorno non esclude nessuna stazione
+            if i is None or (tipo(lo) <= self.minimi_ultimo[i] and tipo(hi) >= self.massimi_ultimo[i]): continue
+            indici.append(i); minimi.append(lo); massimi.append(hi)
+        if not indici: return np.ones(len(self.valori), dtype=bool)
+        sottomatrice = self.valori[:, indici]
+        return ((sottomatrice >= np.array(minimi, dtype=tipo)) & (sottomatrice <= np.array(massimi, dtype=tipo))).all(axis=1)
+
+# Griglia spaziale: celle di PASSO_GRIGLIA gradi con origine in (0, 0), la stessa usata lato browser
+PASSO_GRIGLIA = 0.25
+KM_PER_GRADO = 111.19
+# Densità dei marker per zoom: al più una stazione "rappresentante" per quadrato di PIXEL_CELLA_DENSITA pixel,
+# tutte le stazioni da ZOOM_DENSITA_PIENA in su
+PIXEL_CELLA_DENSITA = 48
+ZOOM_MIN_DENSITA, ZOOM_DENSITA_PIENA = 3, 12
+# Sopra questa soglia la mappa riepilogativa carica di default solo le stazioni nell'area visibile
+SOGLIA_CULLING = 1000
+
+def haversine_km(lat1, lon1, lat2, lon2):
+    lat1, lon1, lat2, lon2 = (np.radians(np.asarray(v, dtype=np.float64)) for v in (lat1, lon1, lat2, lon2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * 6371.0 * np.arcsin(np.sqrt(a))
+
+class SpatialIndex:
+    """Griglia regolare sulle coordinate delle stazioni, per ricerche per riquadro e per le N più vicine.
+
+    Le posizioni restituite sono indici negli array lat/lon passati al costruttore.
+    """
+    def __init__(self, lat, lon, passo=PASSO_GRIGLIA):
+        self.lat = np.asarray(lat, dtype=np.float64); self.lon = np.asarray(lon, dtype=np.float64); self.passo = passo
+        cy, cx = np.floor(self.lat / passo).astype(np.int64), np.floor(self.lon / passo).astype(np.int64)
+        self.ordine = np.lexsort((cx, cy))
+        # Celle occupate: coordinate e intervallo in self.ordine
+        chiavi = np.stack([cy[self.ordine], cx[self.ordine]], axis=1)
+        nuove = np.ones(len(chiavi), dtype=bool); nuove[1:] = (chiavi[1:] != chiavi[:-1]).any(axis=1)
+        self.celle_inizio = np.flatnonzero(nuove)
+        self.celle_fine = np.append(self.celle_inizio[1:], len(chiavi))
+        self.celle_y, self.celle_x = chiavi[self.celle_inizio, 0], chiavi[self.celle_inizio, 1]
+
+    def __len__(self):
+        return len(self.lat)
+
+    def _cells_points(self, y0, y1, x0, x1, solo_bordo=None):
+        selezione = (self.celle_y >= y0) & (self.celle_y <= y1) & (self.celle_x >= x0) & (self.celle_x <= x1)
+        if solo_bordo is not None:
+            # Solo l'anello di celle a distanza (in celle) solo_bordo dal centro del quadrato
+            cy, cx = (y0 + y1) // 2, (x0 + x1) // 2
+            selezione &= np.maximum(np.abs(self.celle_y - cy), np.abs(self.celle_x - cx)) == solo_bordo
+        if not selezione.any(): return np.empty(0, dtype=np.int64)
+        return np.concatenate([self.ordine[a:b] for a, b in zip(self.celle_inizio[selezione], self.celle_fine[selezione])])
+
+    def in_bbox(self, sud, ovest, nord, est):
+        candidati = self._cells_points(int(np.floor(sud / self.passo)), int(np.floor(nord / self.passo)), int(np.floor(ovest / self.passo)), int(np.floor(est / self.passo)))
+        dentro = (self.lat[candidati] >= sud) & (self.lat[candidati] <= nord) & (self.lon[candidati] >= ovest) & (self.lon[candidati] <= est)
+        return np.sort(candidati[dentro])
+
+    def nearest(self, lat, lon, n=5):
+        # Ricerca ad anelli di celle crescenti: ci si ferma quando l'n-esima distanza trovata non può essere
+        # battuta da punti fuori dal quadrato già esplorato
+        if not len(self): return np.empty(0, dtype=np.int64), np.empty(0)
+        cy, cx = int(np.floor(lat / self.passo)), int(np.floor(lon / self.passo))
+        k_max = int(max(abs(self.celle_y - cy).max(), abs(self.celle_x - cx).max()))
+        posizioni, distanze = np.empty(0, dtype=np.int64), np.empty(0)
+        for k in range(k_max + 1):
+            nuovi = self._cells_points(cy - k, cy + k, cx - k, cx + k, solo_bordo=k)
+            if len(nuovi):
+                posizioni = np.append(posizioni, nuovi); distanze = np.append(distanze, haversine_km(lat, lon, self.lat[nuovi], self.lon[nuovi]))
+            sicuro = k * self.passo * KM_PER_GRADO * np.cos(np.radians(min(89.0, abs(lat) + (k + 1) * self.passo)))
+            if len(distanze) >= n and np.partition(distanze, n - 1)[n - 1] <= sicuro: break
+        primi = np.argsort(distanze, kind='stable')[:n]
+        return posizioni[primi], distanze[primi]
+
+    def zoom_levels(self):
+        # Zoom minimo a cui mostrare ogni punto: a ogni zoom il primo punto (in ordine di riga) di ogni cella
+        # di PIXEL_CELLA_DENSITA pixel fa da rappresentante
+        livelli = np.full(len(self), ZOOM_DENSITA_PIENA, dtype=np.int64)
+        for zoom in range(ZOOM_DENSITA_PIENA - 1, ZOOM_MIN_DENSITA - 1, -1):
+            passo = PIXEL_CELLA_DENSITA * 360.0 / (256 * 2 ** zoom)
+            celle = np.floor(self.lat / passo).astype(np.int64) * 1_000_000 + np.floor(self.lon / passo).astype(np.int64)
+            _, primi = np.unique(celle, return_index=True)
+            livelli[primi] = zoom
+        return livelli
+
+# Superficie di pioggia interpolata (IDW) per l'analisi di periodo
+RISOLUZIONI_IDW = [100, 200, 300, 400]
+POTENZA_IDW = 2
+# Celle più lontane di così dalla stazione più vicina restano trasparenti (niente estrapolazione su mare e zone vuote)
+RAGGIO_IDW_KM = 25.0
+# Elementi celle x stazioni elaborati per blocco: limita la memoria a qualche decina di MB anche su griglie fini
+ELEMENTI_BLOCCO_IDW = 4_000_000
+
+def idw_surface(lat, lon, valori, n_celle=200, potenza=POTENZA_IDW, raggio_km=RAGGIO_IDW_KM):
+    """Interpolazione a distanza inversa dei valori delle stazioni su una griglia regolare in Web Mercator.
+
+    Le righe della griglia sono equispaziate nella y di Mercator (dall'alto verso il basso), così l'immagine si
+    sovrappone alla mappa senza riproiezione; il lato più lungo del riquadro ha n_celle celle. Ritorna
+    (griglia float32 con NaN oltre raggio_km, [[sud, ovest], [nord, est]]) oppure None senza stazioni valide.
+    """
+    lat, lon, valori = (np.asarray(v, dtype=np.float64) for v in (lat, lon, valori))
+    validi = ~(np.isnan(lat) | np.isnan(lon) | np.isnan(valori))
+    lat, lon, valori = lat[validi], lon[validi], valori[validi].astype(np.float32)
+    if not len(valori): return None
+
+    # Riquadro delle stazioni allargato del raggio, in gradi
+    margine_lat = raggio_km / KM_PER_GRADO
+    margine_lon = margine_lat / max(np.cos(np.radians(lat.mean())), 0.1)
+    sud, nord = max(lat.min() - margine_lat, -85.0), min(lat.max() + margine_lat, 85.0)
+    ovest, est = lon.min() - margine_lon, lon.max() + margine_lon
+    y_nord, y_sud = (np.log(np.tan(np.pi / 4 + np.radians(v) / 2)) for v in (nord, sud))
+    larghezza, altezza = np.radians(est - ovest), y_nord - y_sud
+    n_x = n_celle if larghezza >= altezza else max(1, round(n_celle * larghezza / altezza))
+    n_y = n_celle if altezza > larghezza else max(1, round(n_celle * altezza / larghezza))
+
+    # Centri delle celle: latitudine per riga (da nord), longitudine per colonna
+    y = y_nord - (np.arange(n_y) + 0.5) * altezza / n_y
+    lat_righe = np.degrees(2 * np.arctan(np.exp(y)) - np.pi / 2)
+    lon_colonne = ovest + (np.arange(n_x) + 0.5) * (est - ovest) / n_x
+
+    # Distanze equirettangolari in km al quadrato: dlat^2 dipende solo da (riga, stazione),
+    # dlon^2 da (colonna, stazione) e viene scalato per cos^2 della latitudine della riga
+    dlon2 = (((lon_colonne[:, None] - lon[None, :]) * KM_PER_GRADO) ** 2).astype(np.float32)
+    dlat2 = (((lat_righe[:, None] - lat[None, :]) * KM_PER_GRADO) ** 2).astype(np.float32)
+    cos2 = (np.cos(np.radians(lat_righe)) ** 2).astype(np.float32)
+
+    griglia = np.empty((n_y, n_x), dtype=np.float32)
+    righe_blocco = max(1, ELEMENTI_BLOCCO_IDW // (n_x * len(valori)))
+    for inizio in range(0, n_y, righe_blocco):
+        fine = min(inizio + righe_blocco, n_y)
+        d2 = cos2[inizio:fine, None, None] * dlon2[None, :, :] + dlat2[inizio:fine, None, :]
+        vicina = d2.min(axis=2)
+        # Su una stazione (distanza ~0) il peso enorme restituisce di fatto il suo valore
+        np.maximum(d2, 1e-6, out=d2)
+        pesi = np.reciprocal(d2, out=d2) if potenza == 2 else np.power(d2, -potenza / 2, out=d2)
+        blocco = (pesi @ valori) / pesi.sum(axis=2)
+        blocco[vicina > raggio_km ** 2] = np.nan
+        griglia[inizio:fine] = blocco
+    return griglia, [[float(sud), float(ovest)], [float(nord), float(est)]]
+
+# --- AGGIORNAMENTO DEI DATI IN BACKGROUND (stale-while-revalidate) ---
+VersioneDati = namedtuple('VersioneDati', ['indice', 'versione', 'caricato_il'])
+
+class DataRefresher:
+    """Ricarica la sorgente in un thread e sostituisce in blocco dataframe e indici quando cambiano.
+
+    Le sessioni leggono sempre la versione corrente senza attendere: finché la nuova non è pronta
+    (scaricata, parsata, indicizzata) resta servita la precedente. All'avvio la prima versione è lo
+    snapshot locale, se esiste; il thread la riconvalida con la sorgente. Dopo un errore il prossimo
+    tentativo arriva con backoff esponenziale tra REFRESH_BACKOFF[0] e REFRESH_BACKOFF[1] secondi.
+    """
+    def __init__(self, url, intervallo=REFRESH_INTERVALLO, backoff=REFRESH_BACKOFF, metriche=None):
+        self.url, self.intervallo, self.backoff, self.metriche = url, intervallo, backoff, metriche
+        self.servita = None
+        self.errore, self.fallimenti, self.ultimo_tentativo = None, 0, None
+        self._lock = threading.Lock()
+        self._primo_tentativo, self._fermo = threading.Event(), threading.Event()
+        self._thread = threading.Thread(target=self._ciclo, name=f"aggiornamento-dati-{hashlib.sha1(url.encode('utf-8')).hexdigest()[:8]}", daemon=True)
+        self.load_snapshot()
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._fermo.set()
+
+    def load_snapshot(self):
+        # Avvio a freddo senza rete: lo snapshot diventa subito la versione servita e current() non attende il download
+        df, meta = read_snapshot(self.url)
+        if df is None: return False
+        try:
+            with measure(self.metriche, "indice"):
+                indice = DataIndex(df, meta.get("sha256")); indice.precompute()
+        except Exception:
+            return False  # snapshot non indicizzabile: si attende il primo caricamento dalla sorgente
+        with self._lock:
+            self.servita = VersioneDati(indice, meta.get("sha256"), meta.get("caricato_il") or "snapshot locale")
+        self._primo_tentativo.set()
+        return True
+
+    def current(self):
+        # Senza snapshot si attende il primo caricamento; poi si serve subito la versione corrente (None se il primo è fallito)
+        self._primo_tentativo.wait()
+        return self.servita
+
+    def next_delay(self):
+        if not self.fallimenti: return self.intervallo
+        return min(self.backoff[0] * 2 ** (self.fallimenti - 1), self.backoff[1])
+
+    def refresh(self):
+        with self._lock:
+            self.ultimo_tentativo = datetime.now()
+            try:
+                df, meta = load_and_prepare_data(self.url, self.metriche)
+                versione = meta.get("sha256") or self.ultimo_tentativo.isoformat()
+                if self.servita is None or versione != self.servita.versione:
+                    with measure(self.metriche, "indice"):
+                        indice = DataIndex(df, versione); indice.precompute()
+                    # Unica assegnazione: chi legge vede la versione vecchia o quella nuova completa
+                    self.servita = VersioneDati(indice, versione, meta.get("caricato_il") or self.ultimo_tentativo.strftime("%d/%m/%Y %H:%M:%S"))
+                if meta.get("errore"):
+                    raise OSError(f"sorgente non raggiungibile, in uso lo snapshot locale ({meta['errore']})")
+                self.errore, self.fallimenti = None, 0
+            except Exception as e:
+                self.errore, self.fallimenti = str(e), self.fallimenti + 1
+                if self.metriche is not None: self.metriche.increment("aggiornamenti_falliti")
+            return self.errore is None
+
+    def _ciclo(self):
+        while True:
+            self.refresh()
+            self._primo_tentativo.set()
+            if self._fermo.wait(self.next_delay()): return
+
+@st.cache_resource
+def get_data_refresher(url):
+    return DataRefresher(url, metriche=get_metrics()).start()
+
+# --- MAPPE: MARKER E POPUP ---
+MODALITA_RENDER = ["Leggero (dati condivisi)", "Classico (un popup per marker)"]
+
+STILE_POPUP = ".popup-container{font-family:Arial,sans-serif;font-size:13px;max-height:350px;overflow-y:auto;overflow-x:hidden}h4{margin-top:12px;margin-bottom:5px;color:#0057e7;border-bottom:1px solid #ccc;padding-bottom:3px}table{width:100%;border-collapse:collapse;margin-bottom:10px}td{text-align:left;padding:4px;border-bottom:1px solid #eee}td:first-child{font-weight:bold;color:#333;width:65%}td:last-child{color:#555}.btn-container{text-align:center;margin-top:15px;}.btn{background-color:#007bff;color:white;padding:8px 12px;border-radius:5px;text-decoration:none;font-weight:bold;}"
+# Stesso stile, limitato ai popup: nel modo leggero è un unico foglio di stile condiviso da tutta la pagina
+STILE_POPUP_CONDIVISO = re.sub(r"(^|})(h4|table|td)", r"\1.popup-container \2", STILE_POPUP)
+
+GRUPPI_POPUP = {"Info Stazione": ["STAZIONE", "CODICE", "LEGENDA_DESCRIZIONE", "LEGENDA_COMUNE", "LEGENDA_ALTITUDINE"], "Dati Meteo": ["LEGENDA_TEMPERATURA_MEDIANA_MINIMA", "LEGENDA_TEMPERATURA_MEDIANA", "LEGENDA_UMIDITA_MEDIA_7GG", "LEGENDA_PIOGGE_RESIDUA", "LEGENDA_TOTALE_PIOGGE_MENSILI"], "Analisi Base": ["LEGENDA_MEDIA_PORCINI_CALDO_BASE", "LEGENDA_MEDIA_PORCINI_CALDO_BOOST", "LEGENDA_DURATA_RANGE_CALDO", "LEGENDA_CONTEGGIO_GG_ALLA_RACCOLTA_CALDO", "LEGENDA_MEDIA_PORCINI_FREDDO_BASE", "LEGENDA_MEDIA_PORCINI_FREDDO_BOOST", "LEGENDA_DURATA_RANGE_FREDDO", "LEGENDA_CONTEGGIO_GG_ALLA_RACCOLTA_FREDDO"], "Analisi Sbalzo Migliore": ["LEGENDA_SBALZO_TERMICO_MIGLIORE", "LEGENDA_MEDIA_PORCINI_CALDO_ST_MIGLIORE", "LEGENDA_MEDIA_BOOST_CALDO_ST_MIGLIORE", "LEGENDA_GG_ST_MIGLIORE_CALDO", "LEGENDA_MEDIA_PORCINI_FREDDO_ST_MIGLIORE", "LEGENDA_MEDIA_BOOST_FREDDO_ST_MIGLIORE", "LEGENDA_GG_ST_MIGLIORE_FREDDO"], "Analisi Sbalzo Secondo": ["LEGENDA_SBALZO_TERMICO_SECONDO", "LEGENDA_MEDIA_PORCINI_CALDO_ST_SECONDO", "LEGENDA_MEDIA_BOOST_CALDO_ST_SECONDO", "LEGENDA_GG_ST_SECONDO_CALDO", "LEGENDA_MEDIA_PORCini_FREDDO_ST_SECONDO", "LEGENDA_MEDIA_BOOST_FREDDO_ST_SECONDO", "LEGENDA_GG_ST_SECONDO_FREDDO"]}
+
+COLORI_MARKER = {"ROSSO": "red", "GIALLO": "yellow", "ARANCIONE": "orange", "VERDE": "green"}
+
+def popup_label(col):
+    return col.replace('LEGENDA_', '').replace('_', ' ').title()
+
+def get_marker_color(val): 
+    return COLORI_MARKER.get(str(val).strip().upper(), "gray")
+
+def create_popup_html(row):
+    html = f"""<style>{STILE_POPUP}</style><div class="popup-container">"""
+    for title, columns in GRUPPI_POPUP.items():
+        table_html = "<table>"; has_content = False
+        for col in columns:
+            if col in row.index and pd.notna(row[col]) and str(row[col]).strip() != '':
+                has_content = True; val = row[col]; label = popup_label(col)
+                val_str = f"{val:,.2f}".replace(",", "X").replace(".", ",").replace("X", ".") if isinstance(val, (int, float, np.integer, np.floating)) else str(val)
+                table_html += f"<tr><td>{label}</td><td>{val_str}</td></tr>"
+        table_html += "</table>"
+        if has_content: html += f"<h4>{title}</h4>{table_html}"
+    
+    link = f'?station={row["CODICE"]}'
+    html += f"<div class='btn-container'><a href='{link}' target='_self' class='btn'>📈 Mostra Storico Stazione</a></div></div>"
+    return html
+
+def to_js_payload(obj):
+    # JSON compatto, sicuro da incorporare in un tag <script>
+    return json.dumps(obj, separators=(',', ':'), ensure_ascii=False, allow_nan=False).replace("</", "<\\/")
+
+def frame_to_rows(df, decimali=4):
+    # Righe come liste JSON: numeri arrotondati (i float32 altrimenti diventano 12.300000190734863), NaN -> null
+    df = df.copy()
+    for col in df.columns:
+        if pd.api.types.is_float_dtype(df[col]): df[col] = df[col].astype(np.float64).round(decimali)
+    return df.astype(object).where(df.notna(), None).to_numpy().tolist()
+
+# Funzioni JS condivise da tutti i popup del layer (una sola copia per pagina)
+JS_UTILITA_POPUP = """
+function esc(v) { return String(v).replace(/[&<>"']/g, function(c) { return {'&': '&amp;', '<': '&lt;', '>': '&gt;', '"': '&quot;', "'": '&#39;'}[c]; }); }
+function fmt(v) {
+    if (typeof v !== 'number') return esc(v);
+    var parti = Math.abs(v).toFixed(2).split('.');
+    return (v < 0 ? '-' : '') + parti[0].replace(/\\B(?=(\\d{3})+(?!\\d))/g, '.') + ',' + parti[1];
+}
+"""
+
+# Template del popup della mappa riepilogativa: stessa struttura HTML di create_popup_html
+JS_POPUP_RIEPILOGO = """function(p, meta) {
+    var html = '<div class="popup-container">';
+    meta.gruppi.forEach(function(gruppo) {
+        var righe = '';
+        gruppo[1].forEach(function(campo) {
+            var v = p[campo[0]];
+            if (v === null || v === undefined || String(v).trim() === '') return;
+            righe += '<tr><td>' + campo[1] + '</td><td>' + fmt(v) + '</td></tr>';
+        });
+        if (righe) html += '<h4>' + gruppo[0] + '</h4><table>' + righe + '</table>';
+    });
+    return html + "<div class='btn-container'><a href='?station=" + encodeURIComponent(p.CODICE) + "' target='_self' class='btn'>📈 Mostra Storico Stazione</a></div></div>";
+}"""
+
+JS_TOOLTIP_RIEPILOGO = "function(p) { return 'Stazione: ' + esc(p.STAZIONE) + ' (' + esc(p.CODICE) + ')'; }"
+
+class StationsLayer(JSCSSMixin, MacroElement):
+    """Layer di circleMarker costruito nel browser da un unico payload JSON.
+
+    Le righe viaggiano una sola volta in forma colonnare; popup e tooltip sono funzioni JS
+    (``function(p, meta)``) invocate al click/hover, lo stile è un solo blocco nell'header.
+    Con ``cluster=True`` i marker vengono raggruppati con Leaflet.markercluster.
+    """
+    _template = Template("""
+        {% macro header(this, kwargs) %}
+            {% if this.stile %}<style>{{ this.stile }}</style>{% endif %}
+        {% endmacro %}
+        {% macro script(this, kwargs) %}
+            var {{ this.get_name() }} = (function() {
+                {{ this.utilita }}
+                var dati = {{ this.dati }}, mappa = {{ this._parent.get_name() }};
+                var popup = {{ this.popup }}, tooltip = {{ this.tooltip }};
+                var gruppo = {% if this.cluster %}L.markerClusterGroup({maxClusterRadius: 40}){% else %}L.featureGroup(){% endif %};
+                var campi = dati.campi, righe = dati.righe, punti = [], marker = [];
+                for (var i = 0; i < righe.length; i++) {
+                    var p = {};
+                    for (var j = 0; j < campi.length; j++) p[campi[j]] = righe[i][j];
+                    punti.push(p);
+                }
+                function crea(i) {
+                    if (!marker[i]) {
+                        var p = punti[i];
+                        marker[i] = L.circleMarker([p.lat, p.lon], {radius: {{ this.raggio }}, color: p.colore, fill: true, fillColor: p.colore, fillOpacity: {{ this.opacita }}, dati: p});
+                        marker[i].bindPopup(function(layer) { return popup(layer.options.dati, dati.meta); }, {maxWidth: {{ this.larghezza_popup }}});
+                        marker[i].bindTooltip(function(layer) { return tooltip(layer.options.dati, dati.meta); });
+                    }
+                    return marker[i];
+                }
+                function aggiungi(lista) { {% if this.cluster %}gruppo.addLayers(lista);{% else %}lista.forEach(function(m) { gruppo.addLayer(m); });{% endif %} }
+                function rimuovi(lista) { {% if this.cluster %}gruppo.removeLayers(lista);{% else %}lista.forEach(function(m) { gruppo.removeLayer(m); });{% endif %} }
+                {% if this.passo_griglia %}
+                // Stessa griglia di SpatialIndex: celle di passo fisso con origine in (0, 0)
+                var passo = {{ this.passo_griglia }}, celle = {}, elenco_celle = [];
+                punti.forEach(function(p, i) {
+                    var y = Math.floor(p.lat / passo), x = Math.floor(p.lon / passo), k = y + ',' + x;
+                    if (!celle[k]) { celle[k] = {y: y, x: x, punti: []}; elenco_celle.push(celle[k]); }
+                    celle[k].punti.push(i);
+                });
+                function nelRiquadro(y0, y1, x0, x1, visita) {
+                    if ((y1 - y0 + 1) * (x1 - x0 + 1) > elenco_celle.length) {
+                        elenco_celle.forEach(function(c) { if (c.y >= y0 && c.y <= y1 && c.x >= x0 && c.x <= x1) visita(c); });
+                    } else {
+                        for (var y = y0; y <= y1; y++) for (var x = x0; x <= x1; x++) { var c = celle[y + ',' + x]; if (c) visita(c); }
+                    }
+                }
+                {% endif %}
+                {% if this.culling %}
+                // Solo i marker nell'area visibile (con un margine) e con densità adatta allo zoom corrente
+                var visibili = {};
+                function aggiorna() {
+                    var b = mappa.getBounds().pad(0.25), z = mappa.getZoom(), nuovi = {}, da_aggiungere = [], da_rimuovere = [];
+                    nelRiquadro(Math.floor(b.getSouth() / passo), Math.floor(b.getNorth() / passo), Math.floor(b.getWest() / passo), Math.floor(b.getEast() / passo), function(c) {
+                        c.punti.forEach(function(i) { if (punti[i].livello <= z) nuovi[i] = true; });
+                    });
+                    for (var i in visibili) if (!nuovi[i]) da_rimuovere.push(marker[i]);
+                    for (var i in nuovi) if (!visibili[i]) da_aggiungere.push(crea(i));
+                    rimuovi(da_rimuovere); aggiungi(da_aggiungere); visibili = nuovi;
+                }
+                mappa.on('moveend', aggiorna); aggiorna();
+                {% else %}
+                aggiungi(punti.map(function(p, i) { return crea(i); }));
+                {% endif %}
+                {% if this.geocoder %}
+                // Risultato del Geocoder: popup con le stazioni più vicine (ricerca ad anelli di celle, come SpatialIndex.nearest)
+                function distanzaKm(lat1, lon1, lat2, lon2) {
+                    var r = Math.PI / 180, a = Math.pow(Math.sin((lat2 - lat1) * r / 2), 2) + Math.cos(lat1 * r) * Math.cos(lat2 * r) * Math.pow(Math.sin((lon2 - lon1) * r / 2), 2);
+                    return 2 * 6371.0 * Math.asin(Math.sqrt(a));
+                }
+                function piuVicine(lat, lon, n) {
+                    var cy = Math.floor(lat / passo), cx = Math.floor(lon / passo), candidati = [], k_max = 0;
+                    elenco_celle.forEach(function(c) { k_max = Math.max(k_max, Math.abs(c.y - cy), Math.abs(c.x - cx)); });
+                    for (var k = 0; k <= k_max; k++) {
+                        nelRiquadro(cy - k, cy + k, cx - k, cx + k, function(c) {
+                            if (Math.max(Math.abs(c.y - cy), Math.abs(c.x - cx)) !== k) return;
+                            c.punti.forEach(function(i) { candidati.push({i: i, d: distanzaKm(lat, lon, punti[i].lat, punti[i].lon)}); });
+                        });
+                        candidati.sort(function(a, b) { return a.d - b.d; });
+                        var sicuro = k * passo * {{ this.km_per_grado }} * Math.cos(Math.min(89, Math.abs(lat) + (k + 1) * passo) * Math.PI / 180);
+                        if (candidati.length >= n && candidati[n - 1].d <= sicuro) break;
+                    }
+                    return candidati.slice(0, n);
+                }
+                {{ this.geocoder }}.on('markgeocode', function(e) {
+                    var centro = e.geocode.center, vicine = piuVicine(centro.lat, centro.lng, {{ this.n_vicine }});
+                    if (!vicine.length) return;
+                    var html = '<div class="popup-container"><h4>Stazioni più vicine</h4><table>' + vicine.map(function(v) {
+                        var p = punti[v.i];
+                        return "<tr><td><a href='?station=" + encodeURIComponent(p.CODICE) + "' target='_self'>" + esc(p.STAZIONE) + '</a></td><td>' + fmt(v.d) + ' km</td></tr>';
+                    }).join('') + '</table></div>';
+                    // Dopo il popup del marker del Geocoder, che altrimenti chiuderebbe questo
+                    setTimeout(function() { L.popup({maxWidth: {{ this.larghezza_popup }}}).setLatLng(centro).setContent(html).openOn(mappa); }, 0);
+                });
+                {% endif %}
+                return gruppo.addTo(mappa);
+            })();
+        {% endmacro %}
+    """)
+
+    def __init__(self, df, colonne, popup, tooltip, meta=None, stile="", raggio=6, opacita=0.9, larghezza_popup=380, cluster=False, culling=False, geocoder=None, n_vicine=5):
+        super().__init__()
+        self._name = "StationsLayer"
+        # Colonne obbligatorie: LATITUDINE, LONGITUDINE e il colore già calcolato per ogni riga (colonna 'colore')
+        df_payload = df[['LATITUDINE', 'LONGITUDINE', 'colore'] + [c for c in colonne if c in df.columns]]
+        campi = ['lat', 'lon', 'colore'] + list(df_payload.columns[3:])
+        if culling:
+            df_payload = df_payload.assign(livello=SpatialIndex(df_payload['LATITUDINE'], df_payload['LONGITUDINE']).zoom_levels()); campi.append('livello')
+        self.dati = to_js_payload({"campi": campi, "righe": frame_to_rows(df_payload), "meta": meta or {}})
+        self.popup, self.tooltip, self.utilita, self.stile = popup, tooltip, JS_UTILITA_POPUP, stile
+        self.raggio, self.opacita, self.larghezza_popup, self.cluster = raggio, opacita, larghezza_popup, cluster
+        # Il Geocoder (GeocoderStazioni) deve essere già stato aggiunto alla mappa: qui serve solo il nome della sua variabile JS
+        self.culling, self.geocoder, self.n_vicine = culling, geocoder.get_name() if geocoder is not None else None, n_vicine
+        self.passo_griglia = PASSO_GRIGLIA if culling or geocoder is not None else None
+        self.km_per_grado = KM_PER_GRADO
+        if cluster:
+            self.default_js = [("markerclusterjs", "https://cdnjs.cloudflare.com/ajax/libs/leaflet.markercluster/1.1.0/leaflet.markercluster.js")]
+            self.default_css = [("markerclustercss", "https://cdnjs.cloudflare.com/ajax/libs/leaflet.markercluster/1.1.0/MarkerCluster.css"),
+                                ("markerclusterdefaultcss", "https://cdnjs.cloudflare.com/ajax/libs/leaflet.markercluster/1.1.0/MarkerCluster.Default.css")]
+
+class GeocoderStazioni(JSCSSMixin, MacroElement):
+    """Come folium.plugins.Geocoder, ma il controllo resta in una variabile JS a cui altri layer possono agganciarsi."""
+    _template = Template("""
+        {% macro script(this, kwargs) %}
+            var {{ this.get_name() }} = L.Control.geocoder({{ this.opzioni }}).on('markgeocode', function(e) {
+                {{ this._parent.get_name() }}.setView(e.geocode.center, {{ this.zoom }});
+            }).addTo({{ this._parent.get_name() }});
+        {% endmacro %}
+    """)
+    default_js = [("Control.Geocoder.js", "https://unpkg.com/leaflet-control-geocoder/dist/Control.Geocoder.js")]
+    default_css = [("Control.Geocoder.css", "https://unpkg.com/leaflet-control-geocoder/dist/Control.Geocoder.css")]
+
+    def __init__(self, collapsed=True, placeholder='Cerca un luogo...', add_marker=True, zoom=11):
+        super().__init__()
+        self._name = "GeocoderStazioni"
+        self.opzioni = to_js_payload({"collapsed": collapsed, "position": "topright", "placeholder": placeholder, "defaultMarkGeocode": add_marker})
+        self.zoom = zoom
+
+# Grafico a barra del popup di periodo in SVG inline: sostituisce la figura Plotly in iframe (250x200, stessi margini)
+JS_POPUP_PERIODO = """function(p) {
+    var W = 250, H = 200, l = 40, r = 20, t = 40, b = 20, w = W - l - r, h = H - t - b;
+    var v = p.TOTALE_PIOGGIA_GIORNO || 0, max = v > 0 ? v * 1.05 : 1;
+    var grezzo = max / 5, ordine = Math.pow(10, Math.floor(Math.log10(grezzo))), passo = ordine * (grezzo / ordine > 5 ? 10 : grezzo / ordine > 2 ? 5 : grezzo / ordine > 1 ? 2 : 1);
+    var decimali = Math.max(0, -Math.floor(Math.log10(passo)));
+    var svg = '<svg xmlns="http://www.w3.org/2000/svg" width="' + W + '" height="' + H + '" font-family="Open Sans, Arial, sans-serif" font-size="12" fill="#444">';
+    svg += '<text x="10" y="24" font-size="14" font-weight="bold">' + esc(p.STAZIONE) + ' (' + esc(p.CODICE) + ')</text>';
+    for (var y = 0; y <= max + 1e-9; y += passo) {
+        var py = Math.round((t + h - y / max * h) * 10) / 10;
+        svg += '<line x1="' + l + '" x2="' + (l + w) + '" y1="' + py + '" y2="' + py + '" stroke="#eee"/><text x="' + (l - 4) + '" y="' + (py + 4) + '" text-anchor="end">' + y.toFixed(decimali) + '</text>';
+    }
+    var bh = Math.round(v / max * h * 10) / 10, cx = l + w / 2;
+    svg += '<rect x="' + (l + w * 0.1) + '" y="' + (t + h - bh) + '" width="' + (w * 0.8) + '" height="' + bh + '" fill="#007bff"/>';
+    svg += bh > 20 ? '<text x="' + cx + '" y="' + (t + h - bh + 16) + '" text-anchor="middle" fill="#fff">' + v.toFixed(1) + ' mm</text>'
+                   : '<text x="' + cx + '" y="' + (t + h - bh - 4) + '" text-anchor="middle">' + v.toFixed(1) + ' mm</text>';
+    svg += '<text x="' + cx + '" y="' + (H - 5) + '" text-anchor="middle">Pioggia Totale</text>';
+    return svg + '<text transform="rotate(-90)" x="' + (-(t + h / 2)) + '" y="12" text-anchor="middle">mm</text></svg>';
+}"""
+
+JS_TOOLTIP_PERIODO = """function(p) {
+    function f1(v) { return v === null || v === undefined ? 'nan' : v.toFixed(1); }
+    return 'Stazione: ' + esc(p.STAZIONE) + ' (' + esc(p.CODICE) + ')<br>Pioggia: ' + f1(p.TOTALE_PIOGGIA_GIORNO) + ' mm<br>T.Max: ' + f1(p.MEDIA_TEMP_MAX) + '°C<br>T.Min: ' + f1(p.MEDIA_TEMP_MIN) + '°C';
+}"""
+
+_HEX = np.array([f"{i:02x}" for i in range(256)])
+
+def colormap_colors(colormap, valori):
+    # Equivalente vettoriale di colormap(x) per una LinearColormap: interpolazione per canale, stringhe "#RRGGBBAA"
+    valori = np.asarray(valori, dtype=np.float64)
+    canali = [(np.interp(valori, colormap.index, [c[j] for c in colormap.colors]) * 255.9999).astype(int) for j in range(4)]
+    return np.char.add(np.char.add(np.char.add(np.char.add("#", _HEX[canali[0]]), _HEX[canali[1]]), _HEX[canali[2]]), _HEX[canali[3]])
+
+def surface_overlay(superficie, colormap, opacita=0.6):
+    # Un'unica immagine RGBA colorata con la stessa scala dei marker; le celle NaN restano trasparenti
+    griglia, bounds = superficie
+    immagine = np.zeros(griglia.shape + (4,), dtype=np.uint8)
+    presenti = ~np.isnan(griglia)
+    for j in range(4):
+        immagine[..., j][presenti] = (np.interp(griglia[presenti], colormap.index, [c[j] for c in colormap.colors]) * 255.9999).astype(np.uint8)
+    return folium.raster_layers.ImageOverlay(immagine, bounds=bounds, opacity=opacita, pixelated=False, name="Pioggia interpolata (IDW)")
+
+# --- CACHE DELLE MAPPE RENDERIZZATE ---
+MAX_MAPPE_IN_CACHE = 16
+# Limite sulla dimensione totale dell'HTML in cache: una mappa classica con 10k stazioni supera i 35 MB
+MAX_MB_MAPPE_IN_CACHE = float(os.environ.get("MAPPA_CACHE_MAPPE_MB", 64))
+
+class MapHtmlCache:
+    """LRU dell'HTML delle mappe già renderizzate, con chiave l'hash di versione dati + stato della vista.
+
+    Limitata sia nel numero di voci sia nei byte totali (lunghezza dell'HTML); una mappa più grande
+    dell'intero limite non viene conservata. Quando arriva una nuova versione dei dati le voci precedenti vengono scartate.
+    Hit e miss sono contati da Metrics (cache "mappe"), non qui.
+    """
+    def __init__(self, max_voci=MAX_MAPPE_IN_CACHE, max_byte=int(MAX_MB_MAPPE_IN_CACHE * 1024 * 1024)):
+        self.max_voci, self.max_byte = max_voci, max_byte
+        self._voci = OrderedDict()
+        self._lock = threading.Lock()
+        self.versione, self.byte = None, 0
+
+    def get_or_build(self, versione, stato, costruisci):
+        chiave = hashlib.sha256(repr((versione, stato)).encode("utf-8")).hexdigest()
+        with self._lock:
+            if versione != self.versione:
+                self._voci.clear(); self.versione, self.byte = versione, 0
+            if chiave in self._voci:
+                self._voci.move_to_end(chiave)
+                return self._voci[chiave]
+        # Costruzione fuori dal lock: sessioni con viste diverse non si bloccano a vicenda
+        html = costruisci()
+        with self._lock:
+            if versione == self.versione and len(html) <= self.max_byte and chiave not in self._voci:
+                self._voci[chiave] = html; self.byte += len(html)
+                while len(self._voci) > self.max_voci or self.byte > self.max_byte:
+                    self.byte -= len(self._voci.popitem(last=False)[1])
+        return html
+
+    def stats(self):
+        with self._lock:
+            return {"voci": len(self._voci), "byte": self.byte}
+
+@st.cache_resource
+def get_map_cache(): return MapHtmlCache()
+
+def show_cached_map(versione, stato, costruisci, width=1000, height=700):
+    # Come folium_static, ma l'HTML della mappa viene riusato finché dati e stato della vista non cambiano
+    metriche = get_metrics(); metriche.cache_lookup("mappe")
+    def costruisci_html():
+        metriche.cache_miss("mappe")
+        with metriche.timer("costruzione_mappa"): mappa = costruisci()
+        with metriche.timer("serializzazione_mappa"): return folium.Figure().add_child(mappa).render()
+    html = get_map_cache().get_or_build(versione, stato, costruisci_html)
+    st.iframe(html, height=height + 10, width=width)
 
 def create_map(tile, location=[43.8, 11.0], zoom=8):
     return folium.Map(location=location, zoom_start=zoom, tiles=tile)
 
-def display_main_map(df, last_loaded_ts):
+def build_main_map(df_mappa, map_tile, leggero=True, cluster=False, culling=False):
+    mappa = create_map(map_tile)
+    if not df_mappa.empty:
+        # Vista sull'estensione delle stazioni (non più fissa sulla Toscana); con una sola stazione, o tutte
+        # nello stesso punto, lo zoom si ferma dove la mappa mostra già tutti i marker
+        mappa.fit_bounds([[float(df_mappa['LATITUDINE'].min()), float(df_mappa['LONGITUDINE'].min())], [float(df_mappa['LATITUDINE'].max()), float(df_mappa['LONGITUDINE'].max())]],
+                         max_zoom=ZOOM_DENSITA_PIENA)
+    geocoder = GeocoderStazioni(collapsed=True, placeholder='Cerca un luogo...', add_marker=True).add_to(mappa)
+
+    if leggero:
+        df_layer = df_mappa.copy()
+        df_layer['colore'] = df_layer['LEGENDA_COLORE'].astype(str).str.strip().str.upper().map(COLORI_MARKER).fillna("gray") if 'LEGENDA_COLORE' in df_layer.columns else "gray"
+        # Solo le colonne dei popup effettivamente presenti, con le etichette già calcolate
+        gruppi = [[titolo, [[col, popup_label(col)] for col in colonne if col in df_layer.columns]] for titolo, colonne in GRUPPI_POPUP.items()]
+        colonne = list(dict.fromkeys([col for _, campi in gruppi for col, _ in campi] + ['STAZIONE', 'CODICE']))
+        StationsLayer(df_layer, colonne, JS_POPUP_RIEPILOGO, JS_TOOLTIP_RIEPILOGO, meta={"gruppi": gruppi}, stile=STILE_POPUP_CONDIVISO,
+                      cluster=cluster, culling=culling, geocoder=geocoder).add_to(mappa)
+        return mappa
+
+    destinazione = MarkerCluster(options={"maxClusterRadius": 40}).add_to(mappa) if cluster else mappa
+    for _, row in df_mappa.iterrows():
+        try:
+            lat, lon = float(row['LATITUDINE']), float(row['LONGITUDINE'])
+            colore = get_marker_color(row.get('LEGENDA_COLORE', 'gray'))
+            popup_html = create_popup_html(row)
+            popup = folium.Popup(popup_html, max_width=380)
+            tooltip_text = f"Stazione: {row['STAZIONE']} ({row['CODICE']})"
+
+            folium.CircleMarker(
+                location=[lat, lon], radius=6, color=colore, fill=True, fill_color=colore,
+                fill_opacity=0.9, popup=popup, tooltip=tooltip_text
+            ).add_to(destinazione)
+        except (ValueError, TypeError):
+            continue
+    return mappa
+
+def build_period_map(df_agg, map_tile, map_center, leggero=True, cluster=False, superficie=None):
+    mappa = create_map(map_tile, location=map_center, zoom=8)
+    if df_agg.empty: return mappa
+
+    min_rain, max_rain = df_agg['TOTALE_PIOGGIA_GIORNO'].min(), df_agg['TOTALE_PIOGGIA_GIORNO'].max()
+    colormap = linear.YlGnBu_09.scale(vmin=min_rain, vmax=max_rain if max_rain > min_rain else min_rain + 1); colormap.caption = 'Totale Piogge (mm) nel Periodo'; mappa.add_child(colormap)
+    if superficie is not None: surface_overlay(superficie, colormap).add_to(mappa)
+
+    if leggero:
+        df_layer = df_agg.copy()
+        df_layer['colore'] = colormap_colors(colormap, df_layer['TOTALE_PIOGGIA_GIORNO'])
+        StationsLayer(df_layer, ['CODICE', 'STAZIONE', 'TOTALE_PIOGGIA_GIORNO', 'MEDIA_TEMP_MAX', 'MEDIA_TEMP_MIN'], JS_POPUP_PERIODO, JS_TOOLTIP_PERIODO,
+                      raggio=8, opacita=0.7, larghezza_popup=300, cluster=cluster).add_to(mappa)
+        return mappa
+
+    destinazione = MarkerCluster(options={"maxClusterRadius": 40}).add_to(mappa) if cluster else mappa
+    for _, row in df_agg.iterrows():
+        title_text = f"<b>{row['STAZIONE']} ({row['CODICE']})</b>"
+        fig = go.Figure(go.Bar(x=['Pioggia Totale'], y=[row['TOTALE_PIOGGIA_GIORNO']], marker_color='#007bff', text=[f"{row['TOTALE_PIOGGIA_GIORNO']:.1f} mm"], textposition='auto'))
+        fig.update_layout(title_text=title_text, title_font_size=14, yaxis_title="mm", width=250, height=200, margin=dict(l=40,r=20,t=40,b=20), showlegend=False)
+        iframe = folium.IFrame(fig.to_html(full_html=False, include_plotlyjs='cdn', config={'displayModeBar': False}), width=280, height=220)
+        popup = folium.Popup(iframe, max_width=300)
+        
+        lat, lon = float(row['LATITUDINE']), float(row['LONGITUDINE'])
+        color = colormap(row['TOTALE_PIOGGIA_GIORNO'])
+        tooltip_text = f"Stazione: {row['STAZIONE']} ({row['CODICE']})<br>Pioggia: {row['TOTALE_PIOGGIA_GIORNO']:.1f} mm<br>T.Max: {row.get('MEDIA_TEMP_MAX', 0.0):.1f}°C<br>T.Min: {row.get('MEDIA_TEMP_MIN', 0.0):.1f}°C"
+        folium.CircleMarker(location=[lat, lon], radius=8, color=color, fill=True, fill_color=color, fill_opacity=0.7, popup=popup, tooltip=tooltip_text).add_to(destinazione)
+    return mappa
+
+def display_main_map(indice, last_loaded_ts):
     st.header("🗺️ Mappa Riepilogativa (Situazione Attuale)")
     
-    df_with_valid_dates = df.dropna(subset=['DATA'])
-    if df_with_valid_dates.empty:
+    if indice.ultima_data is None:
         st.error("ERRORE: Non sono state trovate righe con date valide nel file.")
         return
 
-    last_date = df_with_valid_dates['DATA'].max()
-    df_latest = df_with_valid_dates[df_with_valid_dates['DATA'] == last_date].copy()
+    last_date = indice.ultima_data
+    df_latest = indice.df_ultimo
     st.info(f"Visualizzazione dati aggiornati al: **{last_date.strftime('%d/%m/%Y')}**")
 
     st.sidebar.title("Informazioni e Filtri Riepilogo"); st.sidebar.markdown("---")
     map_tile = st.sidebar.selectbox("Tipo di mappa:", ["OpenStreetMap", "CartoDB positron"], key="tile_main")
     st.sidebar.markdown("---"); st.sidebar.subheader("Statistiche")
-    counter = get_view_counter(); st.sidebar.info(f"Visite totali: **{counter['count']}**")
+    st.sidebar.info(f"Visite totali: **{get_metrics().counter('visite')}**")
     if last_loaded_ts: st.sidebar.info(f"App aggiornata il: **{last_loaded_ts}**")
     try:
         if 'LEGENDA_ULTIMO_AGGIORNAMENTO_SHEET' in df_latest.columns and not df_latest['LEGENDA_ULTIMO_AGGIORNAMENTO_SHEET'].empty:
@@ -101,93 +1147,71 @@ def display_main_map(df, last_loaded_ts):
     except IndexError: pass
 
     st.sidebar.markdown("---"); st.sidebar.subheader("Filtri Dati Standard")
-    df_filtrato = df_latest.copy()
+    filtri = indice.filtri
+    selezioni = {}
 
     for colonna in COLONNE_FILTRO_RIEPILOGO:
-        if colonna in df.columns and pd.to_numeric(df[colonna], errors='coerce').notna().any():
-            max_val = float(pd.to_numeric(df[colonna], errors='coerce').max())
+        if colonna in filtri.massimi:
+            max_val = filtri.massimi[colonna]
             slider_label = colonna.replace('LEGENDA_', '').replace('_', ' ').title()
-            val_selezionato = st.sidebar.slider(f"Filtra per {slider_label}", min_value=0.0, max_value=max_val if max_val > 0 else 1.0, value=(0.0, max_val))
-            if colonna in df_filtrato.columns:
-                col_numerica = pd.to_numeric(df_filtrato[colonna], errors='coerce').fillna(0)
-                df_filtrato = df_filtrato[col_numerica.between(val_selezionato[0], val_selezionato[1])]
+            selezioni[colonna] = st.sidebar.slider(f"Filtra per {slider_label}", min_value=0.0, max_value=max_val if max_val > 0 else 1.0, value=(0.0, max_val))
 
     st.sidebar.markdown("---"); st.sidebar.subheader("Filtri Sbalzo Termico")
-    for sbalzo_col, suffisso in [("LEGENDA_SBALZO_NUMERICO_MIGLIORE", "Migliore"), ("LEGENDA_SBALZO_NUMERICO_SECONDO", "Secondo")]:
-        if sbalzo_col in df.columns and pd.to_numeric(df[sbalzo_col], errors='coerce').notna().any():
-            max_val = float(pd.to_numeric(df[sbalzo_col], errors='coerce').max())
-            val_selezionato = st.sidebar.slider(f"Sbalzo Termico {suffisso}", min_value=0.0, max_value=max_val if max_val > 0 else 1.0, value=(0.0, max_val))
-            if sbalzo_col in df_filtrato.columns:
-                col_numerica = pd.to_numeric(df_filtrato[sbalzo_col], errors='coerce').fillna(0)
-                df_filtrato = df_filtrato[col_numerica.between(val_selezionato[0], val_selezionato[1])]
+    for sbalzo_col, suffisso in COLONNE_SBALZO_FILTRO:
+        if sbalzo_col in filtri.massimi:
+            max_val = filtri.massimi[sbalzo_col]
+            selezioni[sbalzo_col] = st.sidebar.slider(f"Sbalzo Termico {suffisso}", min_value=0.0, max_value=max_val if max_val > 0 else 1.0, value=(0.0, max_val))
+    with get_metrics().timer("filtri"): df_filtrato = df_latest[filtri.mask(selezioni)]
     
-    st.sidebar.markdown("---"); st.sidebar.success(f"Visualizzati {len(df_filtrato)} marker sulla mappa.")
+    st.sidebar.markdown("---"); st.sidebar.subheader("Rendering Mappa")
+    modalita_render = st.sidebar.selectbox("Modalità marker:", MODALITA_RENDER, key="render_main")
+    raggruppa = st.sidebar.checkbox("Raggruppa marker vicini", value=False, key="cluster_main")
+    leggero = modalita_render.startswith("Leggero")
+    # Il culling esiste solo nel modo leggero: nel classico l'opzione non compare e non entra nella chiave della mappa
+    solo_area_visibile = leggero and st.sidebar.checkbox("Carica solo le stazioni nell'area visibile", value=len(df_latest) > SOGLIA_CULLING, key="culling_main",
+                                                         help="Con molte stazioni i marker vengono creati solo per l'area inquadrata, con densità adatta allo zoom.")
+
     df_mappa = df_filtrato.dropna(subset=['LATITUDINE', 'LONGITUDINE', 'CODICE']).copy()
+    if solo_area_visibile:
+        st.sidebar.markdown("---"); st.sidebar.success(f"{len(df_filtrato)} stazioni corrispondono ai filtri: la mappa mostra quelle nell'area visibile, "
+                                                       f"diradate in base allo zoom (tutte da zoom {ZOOM_DENSITA_PIENA}).")
+    else:
+        st.sidebar.markdown("---"); st.sidebar.success(f"Visualizzati {len(df_filtrato)} marker sulla mappa.")
     
-    mappa = create_map(map_tile)
-    Geocoder(collapsed=True, placeholder='Cerca un luogo...', add_marker=True).add_to(mappa)
-
-    def create_popup_html(row):
-        html = """<style>.popup-container{font-family:Arial,sans-serif;font-size:13px;max-height:350px;overflow-y:auto;overflow-x:hidden}h4{margin-top:12px;margin-bottom:5px;color:#0057e7;border-bottom:1px solid #ccc;padding-bottom:3px}table{width:100%;border-collapse:collapse;margin-bottom:10px}td{text-align:left;padding:4px;border-bottom:1px solid #eee}td:first-child{font-weight:bold;color:#333;width:65%}td:last-child{color:#555}.btn-container{text-align:center;margin-top:15px;}.btn{background-color:#007bff;color:white;padding:8px 12px;border-radius:5px;text-decoration:none;font-weight:bold;}</style><div class="popup-container">"""
-        groups = {"Info Stazione": ["STAZIONE", "CODICE", "LEGENDA_DESCRIZIONE", "LEGENDA_COMUNE", "LEGENDA_ALTITUDINE"], "Dati Meteo": ["LEGENDA_TEMPERATURA_MEDIANA_MINIMA", "LEGENDA_TEMPERATURA_MEDIANA", "LEGENDA_UMIDITA_MEDIA_7GG", "LEGENDA_PIOGGE_RESIDUA", "LEGENDA_TOTALE_PIOGGE_MENSILI"], "Analisi Base": ["LEGENDA_MEDIA_PORCINI_CALDO_BASE", "LEGENDA_MEDIA_PORCINI_CALDO_BOOST", "LEGENDA_DURATA_RANGE_CALDO", "LEGENDA_CONTEGGIO_GG_ALLA_RACCOLTA_CALDO", "LEGENDA_MEDIA_PORCINI_FREDDO_BASE", "LEGENDA_MEDIA_PORCINI_FREDDO_BOOST", "LEGENDA_DURATA_RANGE_FREDDO", "LEGENDA_CONTEGGIO_GG_ALLA_RACCOLTA_FREDDO"], "Analisi Sbalzo Migliore": ["LEGENDA_SBALZO_TERMICO_MIGLIORE", "LEGENDA_MEDIA_PORCINI_CALDO_ST_MIGLIORE", "LEGENDA_MEDIA_BOOST_CALDO_ST_MIGLIORE", "LEGENDA_GG_ST_MIGLIORE_CALDO", "LEGENDA_MEDIA_PORCINI_FREDDO_ST_MIGLIORE", "LEGENDA_MEDIA_BOOST_FREDDO_ST_MIGLIORE", "LEGENDA_GG_ST_MIGLIORE_FREDDO"], "Analisi Sbalzo Secondo": ["LEGENDA_SBALZO_TERMICO_SECONDO", "LEGENDA_MEDIA_PORCINI_CALDO_ST_SECONDO", "LEGENDA_MEDIA_BOOST_CALDO_ST_SECONDO", "LEGENDA_GG_ST_SECONDO_CALDO", "LEGENDA_MEDIA_PORCini_FREDDO_ST_SECONDO", "LEGENDA_MEDIA_BOOST_FREDDO_ST_SECONDO", "LEGENDA_GG_ST_SECONDO_FREDDO"]}
-        for title, columns in groups.items():
-            table_html = "<table>"; has_content = False
-            for col in columns:
-                if col in row.index and pd.notna(row[col]) and str(row[col]).strip() != '':
-                    has_content = True; val = row[col]; label = col.replace('LEGENDA_', '').replace('_', ' ').title()
-                    val_str = f"{val:,.2f}".replace(",", "X").replace(".", ",").replace("X", ".") if isinstance(val, (int, float)) else str(val)
-                    table_html += f"<tr><td>{label}</td><td>{val_str}</td></tr>"
-            table_html += "</table>"
-            if has_content: html += f"<h4>{title}</h4>{table_html}"
-        
-        link = f'?station={row["CODICE"]}'
-        html += f"<div class='btn-container'><a href='{link}' target='_self' class='btn'>📈 Mostra Storico Stazione</a></div></div>"
-        return html
+    stato = ("riepilogo", map_tile, sorted(selezioni.items()), modalita_render, raggruppa, solo_area_visibile)
+    show_cached_map(indice.versione, stato, lambda: build_main_map(df_mappa, map_tile, leggero=leggero, cluster=raggruppa, culling=solo_area_visibile))
+    richieste, miss = get_metrics().cache_counts("mappe"); statistiche_cache = get_map_cache().stats()
+    st.sidebar.caption(f"Cache mappe: {richieste - miss} hit / {miss} miss ({statistiche_cache['voci']} in memoria, {statistiche_cache['byte'] / 2**20:.1f} MB)")
 
-    def get_marker_color(val): 
-        return {"ROSSO": "red", "GIALLO": "yellow", "ARANCIONE": "orange", "VERDE": "green"}.get(str(val).strip().upper(), "gray")
-    
-    for _, row in df_mappa.iterrows():
-        try:
-            lat, lon = float(row['LATITUDINE']), float(row['LONGITUDINE'])
-            colore = get_marker_color(row.get('LEGENDA_COLORE', 'gray'))
-            popup_html = create_popup_html(row)
-            popup = folium.Popup(popup_html, max_width=380)
-            tooltip_text = f"Stazione: {row['STAZIONE']} ({row['CODICE']})"
+@st.cache_data(max_entries=16, show_spinner=False)
+def get_rain_surface(versione, start_date, end_date, n_celle, _indice):
+    # Superficie per versione dei dati, periodo e risoluzione, dai totali di tutte le stazioni (i filtri non la cambiano).
+    # Le stazioni senza misure di pioggia nel periodo restano fuori: non sono punti a 0 mm
+    metriche = get_metrics(); metriche.cache_miss("superficie_idw")
+    with metriche.timer("superficie_idw"):
+        df_agg = _indice.cubo.aggregate(start_date, end_date, solo_misurate=True)
+        return idw_surface(df_agg['LATITUDINE'], df_agg['LONGITUDINE'], df_agg['TOTALE_PIOGGIA_GIORNO'], n_celle)
 
-            folium.CircleMarker(
-                location=[lat, lon], radius=6, color=colore, fill=True, fill_color=colore,
-                fill_opacity=0.9, popup=popup, tooltip=tooltip_text
-            ).add_to(mappa)
-        except (ValueError, TypeError):
-            continue
-            
-    folium_static(mappa, width=1000, height=700)
-
-def display_period_analysis(df):
+def display_period_analysis(indice):
     st.header("📊 Analisi di Periodo con Dati Aggregati")
     st.sidebar.title("Filtri di Periodo")
     map_tile = st.sidebar.selectbox("Tipo di mappa:", ["OpenStreetMap", "CartoDB positron"], key="tile_period")
 
-    df_with_dates = df.dropna(subset=['DATA', 'CODICE'])
-    if df_with_dates.empty:
+    if indice.ultima_data is None or not len(indice.codici_stazioni):
         st.error("ERRORE: Dati insufficienti per l'analisi di periodo.")
         return
 
-    min_date, max_date = df_with_dates['DATA'].min().date(), df_with_dates['DATA'].max().date()
+    min_date, max_date = indice.prima_data.date(), indice.ultima_data.date()
     
     date_range = st.sidebar.date_input("Seleziona un periodo:", value=(max_date, max_date), min_value=min_date, max_value=max_date)
     if len(date_range) != 2: 
         st.warning("Seleziona un intervallo di date valido."); st.stop()
     
     start_date, end_date = date_range
-    df_filtered = df_with_dates[df_with_dates['DATA'].dt.date.between(start_date, end_date)]
-    
-    agg_cols = {'STAZIONE': 'first', 'TOTALE_PIOGGIA_GIORNO': 'sum', 'LATITUDINE': 'first', 'LONGITUDINE': 'first', 'TEMP_MAX': 'mean', 'TEMP_MIN': 'mean', 'TEMPERATURA_MEDIANA': 'mean'}
-    df_agg = df_filtered.groupby('CODICE').agg(agg_cols).reset_index().dropna(subset=['LATITUDINE', 'LONGITUDINE'])
-    df_agg.rename(columns={'TEMP_MAX': 'MEDIA_TEMP_MAX', 'TEMP_MIN': 'MEDIA_TEMP_MIN', 'TEMPERATURA_MEDIANA': 'MEDIA_TEMP_MEDIANA'}, inplace=True)
+    with get_metrics().timer("aggregazione"): df_agg = indice.cubo.aggregate(start_date, end_date).dropna(subset=['LATITUDINE', 'LONGITUDINE'])
     
     df_agg_filtered = df_agg.copy()
+    selezioni = None
     st.sidebar.subheader("Filtri Dati Aggregati")
     if not df_agg.empty:
         max_rain = float(df_agg['TOTALE_PIOGGIA_GIORNO'].max()) if not df_agg['TOTALE_PIOGGIA_GIORNO'].empty else 100.0
@@ -198,36 +1222,30 @@ def display_period_analysis(df):
         tmin_range = st.sidebar.slider("Temp. Min Media (°C)", -20.0, max_tmin, (-20.0, max_tmin))
         max_tmed = float(df_agg['MEDIA_TEMP_MEDIANA'].max()) if df_agg['MEDIA_TEMP_MEDIANA'].notna().any() else 35.0
         tmed_range = st.sidebar.slider("Temp. Mediana Media (°C)", 0.0, max_tmed, (0.0, max_tmed))
+        selezioni = (rain_range, tmax_range, tmin_range, tmed_range)
 
-        df_agg_filtered = df_agg[df_agg['TOTALE_PIOGGIA_GIORNO'].between(rain_range[0], rain_range[1])]
-        if 'MEDIA_TEMP_MAX' in df_agg_filtered.columns and df_agg_filtered['MEDIA_TEMP_MAX'].notna().any(): df_agg_filtered = df_agg_filtered[df_agg_filtered['MEDIA_TEMP_MAX'].between(tmax_range[0], tmax_range[1])]
-        if 'MEDIA_TEMP_MIN' in df_agg_filtered.columns and df_agg_filtered['MEDIA_TEMP_MIN'].notna().any(): df_agg_filtered = df_agg_filtered[df_agg_filtered['MEDIA_TEMP_MIN'].between(tmin_range[0], tmin_range[1])]
-        if 'MEDIA_TEMP_MEDIANA' in df_agg_filtered.columns and df_agg_filtered['MEDIA_TEMP_MEDIANA'].notna().any(): df_agg_filtered = df_agg_filtered[df_agg_filtered['MEDIA_TEMP_MEDIANA'].between(tmed_range[0], tmed_range[1])]
+        with get_metrics().timer("filtri_periodo"):
+            df_agg_filtered = df_agg[df_agg['TOTALE_PIOGGIA_GIORNO'].between(rain_range[0], rain_range[1])]
+            if 'MEDIA_TEMP_MAX' in df_agg_filtered.columns and df_agg_filtered['MEDIA_TEMP_MAX'].notna().any(): df_agg_filtered = df_agg_filtered[df_agg_filtered['MEDIA_TEMP_MAX'].between(tmax_range[0], tmax_range[1])]
+            if 'MEDIA_TEMP_MIN' in df_agg_filtered.columns and df_agg_filtered['MEDIA_TEMP_MIN'].notna().any(): df_agg_filtered = df_agg_filtered[df_agg_filtered['MEDIA_TEMP_MIN'].between(tmin_range[0], tmin_range[1])]
+            if 'MEDIA_TEMP_MEDIANA' in df_agg_filtered.columns and df_agg_filtered['MEDIA_TEMP_MEDIANA'].notna().any(): df_agg_filtered = df_agg_filtered[df_agg_filtered['MEDIA_TEMP_MEDIANA'].between(tmed_range[0], tmed_range[1])]
 
     st.info(f"Visualizzando **{len(df_agg_filtered)}** stazioni che corrispondono ai filtri.")
     
+    st.sidebar.markdown("---"); st.sidebar.subheader("Rendering Mappa")
+    modalita_render = st.sidebar.selectbox("Modalità marker:", MODALITA_RENDER, key="render_period")
+    raggruppa = st.sidebar.checkbox("Raggruppa marker vicini", value=False, key="cluster_period")
+    mostra_superficie = st.sidebar.checkbox("Superficie di pioggia interpolata (IDW)", value=False, key="idw_period",
+                                            help=f"Totali del periodo di tutte le stazioni interpolati su una griglia (fino a {RAGGIO_IDW_KM:.0f} km dalla stazione più vicina).")
+    risoluzione = st.sidebar.select_slider("Celle per lato della griglia", options=RISOLUZIONI_IDW, value=200, key="idw_risoluzione") if mostra_superficie else None
+    if mostra_superficie: get_metrics().cache_lookup("superficie_idw")
+    superficie = get_rain_surface(indice.versione, start_date, end_date, risoluzione, indice) if mostra_superficie else None
+
     map_center = [df_agg_filtered['LATITUDINE'].mean(), df_agg_filtered['LONGITUDINE'].mean()] if not df_agg_filtered.empty else [43.8, 11.0]
-    mappa = create_map(map_tile, location=map_center, zoom=8)
-    
     if df_agg_filtered.empty: 
         st.warning("Nessuna stazione corrisponde ai filtri selezionati.")
-    else:
-        min_rain, max_rain = df_agg_filtered['TOTALE_PIOGGIA_GIORNO'].min(), df_agg_filtered['TOTALE_PIOGGIA_GIORNO'].max()
-        colormap = linear.YlGnBu_09.scale(vmin=min_rain, vmax=max_rain if max_rain > min_rain else min_rain + 1); colormap.caption = 'Totale Piogge (mm) nel Periodo'; mappa.add_child(colormap)
-        
-        for _, row in df_agg_filtered.iterrows():
-            title_text = f"<b>{row['STAZIONE']} ({row['CODICE']})</b>"
-            fig = go.Figure(go.Bar(x=['Pioggia Totale'], y=[row['TOTALE_PIOGGIA_GIORNO']], marker_color='#007bff', text=[f"{row['TOTALE_PIOGGIA_GIORNO']:.1f} mm"], textposition='auto'))
-            fig.update_layout(title_text=title_text, title_font_size=14, yaxis_title="mm", width=250, height=200, margin=dict(l=40,r=20,t=40,b=20), showlegend=False)
-            iframe = folium.IFrame(fig.to_html(full_html=False, include_plotlyjs='cdn', config={'displayModeBar': False}), width=280, height=220)
-            popup = folium.Popup(iframe, max_width=300)
-            
-            lat, lon = float(row['LATITUDINE']), float(row['LONGITUDINE'])
-            color = colormap(row['TOTALE_PIOGGIA_GIORNO'])
-            tooltip_text = f"Stazione: {row['STAZIONE']} ({row['CODICE']})<br>Pioggia: {row['TOTALE_PIOGGIA_GIORNO']:.1f} mm<br>T.Max: {row.get('MEDIA_TEMP_MAX', 0.0):.1f}°C<br>T.Min: {row.get('MEDIA_TEMP_MIN', 0.0):.1f}°C"
-            folium.CircleMarker(location=[lat, lon], radius=8, color=color, fill=True, fill_color=color, fill_opacity=0.7, popup=popup, tooltip=tooltip_text).add_to(mappa)
-            
-    folium_static(mappa, width=1000, height=700)
+    stato = ("periodo", map_tile, start_date, end_date, selezioni, modalita_render, raggruppa, risoluzione)
+    show_cached_map(indice.versione, stato, lambda: build_period_map(df_agg_filtered, map_tile, map_center, leggero=modalita_render.startswith("Leggero"), cluster=raggruppa, superficie=superficie))
     
     with st.expander("Vedi dati aggregati filtrati"):
         if not df_agg_filtered.empty:
@@ -239,76 +1257,146 @@ def display_period_analysis(df):
         else:
             st.write("Nessun dato da visualizzare in base ai filtri selezionati.")
 
+# --- GRAFICI STORICI DELLA STAZIONE ---
+# Finestra mostrata all'apertura (ultimi 40 giorni), sempre a piena risoluzione
+GIORNI_FINESTRA_GRAFICI = 39
+# Oltre questa soglia di righe lo storico precedente alla finestra viene ridotto a min/max per intervallo
+PUNTI_MAX_GRAFICO = 1000
+INTERVALLI_RIDUZIONE = 250
+
+def sbalzo_events(serie):
+    # Eventi (data, valore) distinti: la stessa stringa "12,5 - 01/10/2025" si ripete su molte righe
+    eventi = set()
+    for sbalzo_str in pd.Series(serie).dropna().astype(str).unique():
+        if " - " not in sbalzo_str: continue
+        try:
+            valore, data_str = sbalzo_str.split(" - ", 1)
+            eventi.add((datetime.strptime(data_str.strip(), "%d/%m/%Y"), valore.strip().replace(",", ".")))
+        except ValueError: continue
+    return sorted(eventi)
+
 def add_sbalzo_line(fig, df_data, sbalzo_col_name, label):
     if sbalzo_col_name not in df_data.columns: return
-    df_valid_sbalzo = df_data.dropna(subset=[sbalzo_col_name])
-    if df_valid_sbalzo.empty: return
-    for _, row in df_valid_sbalzo.iterrows():
-        sbalzo_str = str(row[sbalzo_col_name])
-        if " - " in sbalzo_str:
-            try:
-                valore, data_str = sbalzo_str.split(" - ", 1)
-                sbalzo_val = valore.strip().replace(",", "."); sbalzo_date = datetime.strptime(data_str.strip(), "%d/%m/%Y")
-                fig.add_shape(type="line", x0=sbalzo_date, y0=0, x1=sbalzo_date, y1=1, line=dict(color="Green", width=2, dash="dash"), xref="x", yref="paper")
-                fig.add_annotation(x=sbalzo_date, y=1.05, xref="x", yref="paper", text=f"{label} ({sbalzo_val})", showarrow=False, xanchor="left", font=dict(family="Arial", size=12, color="black"))
-            except ValueError: continue
+    forme, annotazioni = [], []
+    for sbalzo_date, sbalzo_val in sbalzo_events(df_data[sbalzo_col_name]):
+        forme.append(dict(type="line", x0=sbalzo_date, y0=0, x1=sbalzo_date, y1=1, line=dict(color="Green", width=2, dash="dash"), xref="x", yref="paper"))
+        annotazioni.append(dict(x=sbalzo_date, y=1.05, xref="x", yref="paper", text=f"{label} ({sbalzo_val})", showarrow=False, xanchor="left", font=dict(family="Arial", size=12, color="black")))
+    # Un'unica assegnazione invece di un add_shape/add_annotation per evento (update_layout rifonderebbe forma per forma)
+    if forme: fig.layout.shapes = list(fig.layout.shapes) + forme; fig.layout.annotations = list(fig.layout.annotations) + annotazioni
 
-def display_station_detail(df, station_code):
-    if st.button("⬅️ Torna alla Mappa Riepilogativa"): 
-        st.query_params.clear()
+def downsample_positions(serie_valori, n_storico, n_intervalli=INTERVALLI_RIDUZIONE):
+    """Posizioni delle righe da disegnare: le prime n_storico sono divise in n_intervalli e di ognuno si tengono
+    minimo e massimo di ogni serie (più il primo punto dello storico); le righe successive restano tutte.
 
-    df_station = df[df['CODICE'] == station_code].sort_values('DATA').copy()
-    
-    if df_station.empty: 
-        st.error(f"Dati non trovati per la stazione con codice: {station_code}.")
-        return
+    Picchi e minimi dello storico sopravvivono alla riduzione e le serie di uno stesso grafico condividono l'asse x.
+    """
+    n_totale = len(serie_valori[0]) if serie_valori else 0
+    if n_storico <= 4 * n_intervalli: return np.arange(n_totale)
+    confini = np.linspace(0, n_storico, n_intervalli + 1).astype(np.int64)
+    intervallo = np.repeat(np.arange(n_intervalli), np.diff(confini))
+    posizioni = [np.zeros(1, dtype=np.int64), np.arange(n_storico, n_totale)]
+    for valori in serie_valori:
+        valori = np.asarray(valori, dtype=np.float64)[:n_storico]
+        validi = np.flatnonzero(~np.isnan(valori))
+        if not len(validi): continue
+        # Ordinando per (intervallo, valore) il minimo è il primo elemento di ogni intervallo e il massimo l'ultimo
+        ordine = validi[np.lexsort((valori[validi], intervallo[validi]))]
+        cambi = intervallo[ordine][1:] != intervallo[ordine][:-1]
+        posizioni += [ordine[np.r_[True, cambi]], ordine[np.r_[cambi, True]]]
+    return np.unique(np.concatenate(posizioni))
 
-    descriptive_name = df_station['STAZIONE'].iloc[0]
-    st.header(f"📈 Storico Dettagliato: {descriptive_name} ({station_code})")
+def reduce_history(df_chart, colonne, start_date, riduci):
+    if not riduci or len(df_chart) <= PUNTI_MAX_GRAFICO: return df_chart
+    # Le righe della stazione sono ordinate per data: lo storico prima della finestra è un prefisso
+    n_storico = int((df_chart['DATA'] < start_date).sum())
+    return df_chart.iloc[downsample_positions([df_chart[c].to_numpy(dtype=np.float64, na_value=np.nan) for c in colonne], n_storico)]
 
-    if not df_station.empty: 
-        end_date_default = df_station['DATA'].max()
-        start_date_default = end_date_default - pd.Timedelta(days=39)
-    else: 
-        end_date_default = datetime.now()
-        start_date_default = end_date_default - pd.Timedelta(days=39)
-    
-    config_chart = {'toImageButtonOptions': {'format': 'png', 'scale': 2, 'filename': f'grafico_{station_code}'}, 'displaylogo': False}
+def build_station_figures(df_station, riduci=True):
+    end_date_default = df_station['DATA'].max()
+    start_date_default = end_date_default - pd.Timedelta(days=GIORNI_FINESTRA_GRAFICI)
+    figure = {}
 
     # --- Grafico 1: Precipitazioni ---
-    st.subheader("Andamento Precipitazioni Giornaliere")
-    fig1 = go.Figure(go.Bar(x=df_station['DATA'], y=df_station['TOTALE_PIOGGIA_GIORNO']))
+    df_chart = reduce_history(df_station, ['TOTALE_PIOGGIA_GIORNO'], start_date_default, riduci)
+    fig1 = go.Figure(go.Bar(x=df_chart['DATA'], y=df_chart['TOTALE_PIOGGIA_GIORNO']))
     max_y_rain = df_station['TOTALE_PIOGGIA_GIORNO'].max() * 1.1 if not df_station['TOTALE_PIOGGIA_GIORNO'].empty else 100
     fig1.update_layout(title="Pioggia Giornaliera", xaxis_title="Data", yaxis_title="mm", xaxis_range=[start_date_default, end_date_default], yaxis_range=[0, max_y_rain])
-    st.plotly_chart(fig1, use_container_width=True, config=config_chart)
+    figure['pioggia'] = fig1.to_json()
 
     # --- Grafico 2: Temperatura vs Piogge Residue ---
-    st.subheader("Correlazione Temperatura Mediana e Piogge Residue")
     cols_needed = ['PIOGGE_RESIDUA_ZOFFOLI', 'TEMPERATURA_MEDIANA']
+    figure['residue'] = None
     if all(c in df_station.columns for c in cols_needed) and not df_station.dropna(subset=cols_needed).empty:
-        df_chart = df_station.dropna(subset=cols_needed)
+        df_valid = df_station.dropna(subset=cols_needed)
+        df_chart = reduce_history(df_valid, cols_needed, start_date_default, riduci)
         fig2 = make_subplots(specs=[[{"secondary_y": True}]])
         fig2.add_trace(go.Scatter(x=df_chart['DATA'], y=df_chart['PIOGGE_RESIDUA_ZOFFOLI'], name='Piogge Residua', mode='lines', line=dict(color='blue')), secondary_y=False)
         fig2.add_trace(go.Scatter(x=df_chart['DATA'], y=df_chart['TEMPERATURA_MEDIANA'], name='Temperatura Mediana', mode='lines', line=dict(color='red')), secondary_y=True)
-        max_y_rain_res = df_chart['PIOGGE_RESIDUA_ZOFFOLI'].max() * 1.1; min_y_rain_res = df_chart['PIOGGE_RESIDUA_ZOFFOLI'].min() * 0.9
-        max_y_temp_med = df_chart['TEMPERATURA_MEDIANA'].max() * 1.1; min_y_temp_med = df_chart['TEMPERATURA_MEDIANA'].min() * 0.9
+        max_y_rain_res = df_valid['PIOGGE_RESIDUA_ZOFFOLI'].max() * 1.1; min_y_rain_res = df_valid['PIOGGE_RESIDUA_ZOFFOLI'].min() * 0.9
+        max_y_temp_med = df_valid['TEMPERATURA_MEDIANA'].max() * 1.1; min_y_temp_med = df_valid['TEMPERATURA_MEDIANA'].min() * 0.9
         fig2.update_yaxes(title_text="<b>Piogge Residua</b>", range=[min_y_rain_res, max_y_rain_res], secondary_y=False)
         fig2.update_yaxes(title_text="<b>Temperatura Mediana (°C)</b>", range=[min_y_temp_med, max_y_temp_med], secondary_y=True)
         fig2.update_layout(title_text="Temp vs Piogge", xaxis_range=[start_date_default, end_date_default])
         add_sbalzo_line(fig2, df_station, 'SBALZO_TERMICO_MIGLIORE', 'Sbalzo Migliore'); add_sbalzo_line(fig2, df_station, '2°_SBALZO_TERMICO_MIGLIORE', '2° Sbalzo')
-        st.plotly_chart(fig2, use_container_width=True, config=config_chart)
-    else: 
-        st.warning("Dati di Piogge Residue o Temperatura Mediana non disponibili per creare il grafico.")
+        figure['residue'] = fig2.to_json()
 
     # --- Grafico 3: Temperature Min/Max ---
-    st.subheader("Andamento Temperature Minime e Massime")
+    df_chart = reduce_history(df_station, ['TEMP_MAX', 'TEMP_MIN'], start_date_default, riduci)
     fig3 = go.Figure()
-    fig3.add_trace(go.Scatter(x=df_station['DATA'], y=df_station['TEMP_MAX'], name='Temp Max', line=dict(color='orangered')))
-    fig3.add_trace(go.Scatter(x=df_station['DATA'], y=df_station['TEMP_MIN'], name='Temp Min', line=dict(color='skyblue'), fill='tonexty'))
+    fig3.add_trace(go.Scatter(x=df_chart['DATA'], y=df_chart['TEMP_MAX'], name='Temp Max', line=dict(color='orangered')))
+    fig3.add_trace(go.Scatter(x=df_chart['DATA'], y=df_chart['TEMP_MIN'], name='Temp Min', line=dict(color='skyblue'), fill='tonexty'))
     max_y_temp = df_station['TEMP_MAX'].max() * 1.1 if not df_station['TEMP_MAX'].empty else 40
     min_y_temp = df_station['TEMP_MIN'].min() * 0.9 if not df_station['TEMP_MIN'].empty else -10
     fig3.update_layout(title="Escursione Termica Giornaliera", xaxis_title="Data", yaxis_title="°C", xaxis_range=[start_date_default, end_date_default], yaxis_range=[min_y_temp, max_y_temp])
-    st.plotly_chart(fig3, use_container_width=True, config=config_chart)
+    figure['temperature'] = fig3.to_json()
+    return figure
+
+@st.cache_data(max_entries=64, show_spinner=False)
+def get_station_figures(versione, station_code, riduci, _indice):
+    # JSON delle figure per stazione e versione dei dati: riaprire una stazione non ricostruisce i grafici
+    metriche = get_metrics(); metriche.cache_miss("grafici_stazione")
+    with metriche.timer("grafici_plotly"):
+        return build_station_figures(_indice.station_rows(station_code), riduci)
+
+def display_station_detail(indice, station_code):
+    if st.button("⬅️ Torna alla Mappa Riepilogativa"): 
+        st.query_params.clear()
+
+    df_station = indice.station_rows(station_code)
+    
+    if df_station.empty: 
+        st.error(f"Dati non trovati per la stazione con codice: {station_code}.")
+        return
+
+    descriptive_name = df_station['STAZIONE'].iloc[0]
+    st.header(f"📈 Storico Dettagliato: {descriptive_name} ({station_code})")
+
+    riduci = len(df_station) > PUNTI_MAX_GRAFICO and st.checkbox("Semplifica lo storico lungo (minimi e massimi per intervallo)", value=True, key="riduci_storico",
+                                                                 help=f"Gli ultimi {GIORNI_FINESTRA_GRAFICI + 1} giorni restano a piena risoluzione; dello storico precedente si disegnano picchi e minimi.")
+    get_metrics().cache_lookup("grafici_stazione")
+    figure = get_station_figures(indice.versione, station_code, riduci, indice)
+    config_chart = {'toImageButtonOptions': {'format': 'png', 'scale': 2, 'filename': f'grafico_{station_code}'}, 'displaylogo': False}
+
+    st.subheader("Andamento Precipitazioni Giornaliere")
+    st.plotly_chart(pio.from_json(figure['pioggia']), use_container_width=True, config=config_chart)
+
+    st.subheader("Correlazione Temperatura Mediana e Piogge Residue")
+    if figure['residue']:
+        st.plotly_chart(pio.from_json(figure['residue']), use_container_width=True, config=config_chart)
+    else: 
+        st.warning("Dati di Piogge Residue o Temperatura Mediana non disponibili per creare il grafico.")
+
+    st.subheader("Andamento Temperature Minime e Massime")
+    st.plotly_chart(pio.from_json(figure['temperature']), use_container_width=True, config=config_chart)
+
+    with st.expander("Stazioni più vicine"):
+        coordinate = df_station[['LATITUDINE', 'LONGITUDINE']].dropna()
+        if not coordinate.empty:
+            lat, lon = float(coordinate['LATITUDINE'].iloc[0]), float(coordinate['LONGITUDINE'].iloc[0])
+            vicine = indice.nearest_stations(lat, lon, n=5, escludi=station_code)
+            st.markdown("\n".join(f"- [{row.STAZIONE} ({row.CODICE})](?station={row.CODICE}) – {row.DISTANZA_KM:.1f} km" for row in vicine.itertuples()))
+        else:
+            st.write("Coordinate della stazione non disponibili.")
 
     with st.expander("Visualizza tabella dati storici completi"):
         all_cols = sorted([c for c in df_station.columns if not c.startswith('LEGENDA_') and c not in ['LATITUDINE', 'LONGITUDINE', 'COORDINATEGOOGLE']])
@@ -331,30 +1419,48 @@ def display_station_detail(df, station_code):
         else:
             st.info("Seleziona almeno una colonna.")
 
+def show_metrics_panel(metriche):
+    # Pannello per gli amministratori (MAPPA_METRICHE_ADMIN=1): percentili per fase, hit rate delle cache e dump JSON
+    stato = metriche.snapshot()
+    with st.sidebar.expander("⏱️ Prestazioni (admin)"):
+        if stato["fasi"]:
+            st.dataframe(pd.DataFrame.from_dict(stato["fasi"], orient="index").round(1), use_container_width=True)
+        if stato["cache"]:
+            st.dataframe(pd.DataFrame.from_dict(stato["cache"], orient="index"), use_container_width=True)
+        if stato["contatori"]: st.caption(" · ".join(f"{nome}: {valore}" for nome, valore in sorted(stato["contatori"].items())))
+        st.download_button("Scarica metriche (JSON)", metriche.to_json(), file_name="metriche.json", mime="application/json")
+
 def main():
     st.set_page_config(page_title="Mappa Funghi Protetta", layout="wide")
     st.title("💧 Analisi Meteo Funghi – by Bobo 🍄")
     
-    df, last_loaded_ts = load_and_prepare_data(SHEET_URL)
-    if df is None or df.empty: 
+    aggiornamento = get_data_refresher(SHEET_URL)
+    servita = aggiornamento.current()
+    if servita is None:
+        st.error(f"Errore critico durante il caricamento dei dati: {aggiornamento.errore}"); st.stop()
+    if servita.indice.df_ordinato.empty:
         st.stop()
+    if aggiornamento.errore:
+        st.sidebar.warning(f"Ultimo aggiornamento non riuscito ({aggiornamento.errore}). Dati del {servita.caricato_il}, nuovo tentativo a breve.")
+    indice, last_loaded_ts = servita.indice, servita.caricato_il
     
+    metriche = get_metrics()
     query_params = st.query_params
     if "station" in query_params:
-        display_station_detail(df, query_params["station"])
+        with metriche.timer("vista_stazione"): display_station_detail(indice, query_params["station"])
     else:
         if check_password():
-            counter = get_view_counter()
             if st.session_state.get('just_logged_in', False): 
-                counter["count"] += 1
+                get_metrics().increment("visite")
                 st.session_state['just_logged_in'] = False
             
             mode = st.radio("Seleziona la modalità:", ["Mappa Riepilogativa", "Analisi di Periodo"], horizontal=True)
 
             if mode == "Mappa Riepilogativa": 
-                display_main_map(df, last_loaded_ts)
+                with metriche.timer("vista_riepilogo"): display_main_map(indice, last_loaded_ts)
             elif mode == "Analisi di Periodo": 
-                display_period_analysis(df)
+                with metriche.timer("vista_periodo"): display_period_analysis(indice)
+            if METRICHE_ADMIN: show_metrics_panel(metriche)
 
 if __name__ == "__main__":
     main()
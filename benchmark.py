@@ -0,0 +1,310 @@
+"""Benchmark dell'app al crescere di stazioni e giorni di storico.
+
+mappe: dimensione dell'HTML generato e tempo di render, confrontando il rendering classico (un popup folium
+per marker; nell'analisi di periodo una figura Plotly in iframe per stazione) con quello leggero (payload
+JSON condiviso e popup generati nel browser).
+
+app: genera un CSV sintetico con la forma del foglio Google e misura caricamento, indice, mappa riepilogativa,
+analisi di periodo e dettaglio stazione senza runtime Streamlit (chiamate st sostituite da uno stub).
+Tempo, picco di memoria e dimensione dell'output vengono accodati a un file CSV confrontabile tra commit.
+
+Uso: python benchmark.py mappe [--vista riepilogo periodo] [--stazioni 100 1000 10000]
+     python benchmark.py app [--stazioni 100 1000] [--giorni 365] [--risultati benchmark_risultati.csv]
+"""
+import argparse
+import contextlib
+import csv
+import os
+import subprocess
+import tempfile
+import time
+import tracemalloc
+import types
+from datetime import date, datetime, timedelta
+from functools import cached_property
+
+import folium
+import numpy as np
+import pandas as pd
+import plotly.io as pio
+import streamlit.logger
+
+import app
+
+
+def synthetic_latest_snapshot(n_stazioni, seed=0):
+    # Una riga per stazione con tutte le colonne dei popup, come df_ultimo dopo load_and_prepare_data
+    rng = np.random.default_rng(seed)
+    df = pd.DataFrame({
+        'CODICE': pd.Categorical([f"ST{i:05d}" for i in range(n_stazioni)]),
+        'STAZIONE': pd.Categorical([f"Stazione {i}" for i in range(n_stazioni)]),
+        'LATITUDINE': (42.0 + rng.random(n_stazioni) * 2.5).astype(np.float32),
+        'LONGITUDINE': (9.8 + rng.random(n_stazioni) * 2.5).astype(np.float32),
+        'LEGENDA_COLORE': pd.Categorical(rng.choice(["ROSSO", "GIALLO", "ARANCIONE", "VERDE", ""], n_stazioni)),
+        'LEGENDA_COMUNE': pd.Categorical([f"Comune {i % 200}" for i in range(n_stazioni)]),
+        'LEGENDA_DESCRIZIONE': [f"Bosco misto {i % 7}" for i in range(n_stazioni)],
+    })
+    for suffisso in ("MIGLIORE", "SECONDO"):
+        df[f"LEGENDA_SBALZO_TERMICO_{suffisso}"] = [f"{v:.1f} - 01/10/2025".replace(".", ",") for v in rng.random(n_stazioni) * 10]
+    for colonne in app.GRUPPI_POPUP.values():
+        for col in colonne:
+            if col not in df.columns:
+                valori = (rng.random(n_stazioni) * 100).astype(np.float32)
+                valori[rng.random(n_stazioni) < 0.1] = np.nan
+                df[col] = valori
+    return df
+
+
+def synthetic_period_aggregate(n_stazioni, seed=0):
+    # Stesse colonne di PeriodCube.aggregate
+    rng = np.random.default_rng(seed)
+    df = synthetic_latest_snapshot(n_stazioni, seed)[['CODICE', 'STAZIONE', 'LATITUDINE', 'LONGITUDINE']]
+    df['TOTALE_PIOGGIA_GIORNO'] = rng.gamma(2.0, 40.0, n_stazioni)
+    for col, base in [('MEDIA_TEMP_MAX', 22.0), ('MEDIA_TEMP_MIN', 9.0), ('MEDIA_TEMP_MEDIANA', 15.0)]:
+        df[col] = base + rng.normal(0, 3, n_stazioni)
+    return df
+
+
+def measure_map(costruisci):
+    inizio = time.perf_counter()
+    mappa = costruisci()
+    costruzione = time.perf_counter() - inizio
+    html = folium.Figure().add_child(mappa).render()
+    return {"costruzione_s": costruzione, "totale_s": time.perf_counter() - inizio, "html_kb": len(html.encode("utf-8")) / 1024}
+
+
+# --- CSV SINTETICO CON LA FORMA DEL FOGLIO ---
+# Colonne misurate del foglio oltre a quelle LEGENDA_ dei popup e dei filtri
+COLONNE_MISURE = ['TOTALE_PIOGGIA_GIORNO', 'TEMP_MAX', 'TEMP_MIN', 'TEMPERATURA_MEDIANA', 'TEMPERATURA_MEDIANA_MINIMA', 'PIOGGE_RESIDUA_ZOFFOLI',
+                  'UMIDITA_DEL_GIORNO', 'UMIDITA_MEDIA_7GG', 'VENTO', 'DURATA_RANGE_CALDO', 'DURATA_RANGE_FREDDO', 'BOOST']
+COLONNE_TESTO_LEGENDA = ['LEGENDA_COLORE', 'LEGENDA_COMUNE', 'LEGENDA_DESCRIZIONE', 'LEGENDA_SBALZO_TERMICO_MIGLIORE', 'LEGENDA_SBALZO_TERMICO_SECONDO', 'LEGENDA_ULTIMO_AGGIORNAMENTO_SHEET']
+
+
+def sheet_header(colonna):
+    # Nome "grezzo" come nel foglio: clean_column_name lo riporta al nome pulito
+    if colonna.startswith('LEGENDA_'):
+        return "[Legenda] " + colonna[len('LEGENDA_'):].replace('_', ' ').title()
+    return colonna.replace('_', ' ').title()
+
+
+def write_sheet_csv(path, n_stazioni, n_giorni, seed=0, ultimo_giorno=date(2025, 10, 1), quota_mancanti=0.05):
+    """CSV come l'export del foglio: seconda riga di intestazione da saltare, virgola decimale, #N/D e CRLF."""
+    rng = np.random.default_rng(seed)
+    n = n_stazioni * n_giorni
+    giorni = pd.date_range(end=pd.Timestamp(ultimo_giorno), periods=n_giorni)
+    stazione = np.tile(np.arange(n_stazioni), n_giorni)
+    giorno = np.repeat(np.arange(n_giorni), n_stazioni)
+    lat, lon = 42.0 + rng.random(n_stazioni) * 2.5, 9.8 + rng.random(n_stazioni) * 2.5
+
+    df = pd.DataFrame({
+        'CODICE': np.char.add("ST", np.char.zfill(stazione.astype(str), 5)),
+        'STAZIONE': np.char.add("Stazione ", stazione.astype(str)),
+        'DATA': giorni.strftime("%d/%m/%Y").to_numpy()[giorno],
+        'LATITUDINE': lat[stazione].round(5), 'LONGITUDINE': lon[stazione].round(5),
+    })
+    # Nomi in maiuscolo come dopo clean_column_name (GRUPPI_POPUP contiene anche un nome con minuscole)
+    candidate = dict.fromkeys(c.upper() for c in COLONNE_MISURE + app.COLONNE_FILTRO_RIEPILOGO + [c for g in app.GRUPPI_POPUP.values() for c in g])
+    misure = [c for c in candidate if c not in df.columns and c not in COLONNE_TESTO_LEGENDA and c not in ('STAZIONE', 'CODICE')]
+    for col in misure:
+        valori = (rng.gamma(0.6, 8.0, n) if 'PIOGG' in col else rng.normal(15.0, 6.0, n)).round(1)
+        valori[rng.random(n) < quota_mancanti] = np.nan
+        df[col] = valori
+
+    # Sbalzi termici: un evento ogni 20 giorni per stazione, ripetuto su tutte le righe successive come nel foglio
+    evento = giorno // 20
+    eventi = giorni[evento * 20].strftime("%d/%m/%Y").to_numpy()
+    valori_sbalzo = np.char.replace((rng.random((n_stazioni, evento.max() + 1)) * 10).round(1).astype(str), ".", ",")[stazione, evento]
+    sbalzo = np.char.add(np.char.add(valori_sbalzo, " - "), eventi.astype(str))
+    df['SBALZO_TERMICO_MIGLIORE'] = sbalzo
+    df['2°_SBALZO_TERMICO_MIGLIORE'] = np.where(rng.random(n) < 0.5, sbalzo, "")
+    df['LEGENDA_COLORE'] = rng.choice(["ROSSO", "GIALLO", "ARANCIONE", "VERDE", ""], n)
+    df['LEGENDA_COMUNE'] = np.char.add("Comune ", (stazione % 200).astype(str))
+    df['LEGENDA_DESCRIZIONE'] = np.char.add("Bosco misto ", (stazione % 7).astype(str))
+    df['LEGENDA_SBALZO_TERMICO_MIGLIORE'] = sbalzo
+    df['LEGENDA_SBALZO_TERMICO_SECONDO'] = df['2°_SBALZO_TERMICO_MIGLIORE']
+    df['LEGENDA_ULTIMO_AGGIORNAMENTO_SHEET'] = f"{ultimo_giorno:%d/%m/%Y} 10:00"
+
+    df.columns = [sheet_header(c) for c in df.columns]
+    testo = df.to_csv(index=False, decimal=',', na_rep="#N/D", lineterminator="\r\n")
+    intestazione, dati = testo.split("\r\n", 1)
+    with open(path, "w", encoding="utf-8", newline="") as f:
+        f.write(intestazione + "\r\n" + ",".join("" for _ in df.columns) + "\r\n" + dati)
+    return path
+
+
+# --- VISTE SENZA RUNTIME STREAMLIT ---
+class StreamlitStub:
+    """Sostituto di streamlit per le viste: i widget restituiscono il default (o il valore in `valori`, per etichetta),
+    gli output testuali sono ignorati e quelli pesanti (HTML delle mappe, figure Plotly) vengono solo misurati."""
+    class Stop(Exception): pass
+
+    def __init__(self, valori=None):
+        self.valori = valori or {}
+        self.sidebar = self
+        self.query_params, self.session_state = {}, {}
+        self.column_config = types.SimpleNamespace(LinkColumn=lambda *args, **kwargs: None)
+        self.output_bytes = 0
+
+    def __getattr__(self, nome):
+        # header, info, markdown, dataframe, ...: nessun effetto
+        return lambda *args, **kwargs: None
+
+    def _valore(self, label, default):
+        return self.valori.get(label, default)
+
+    def selectbox(self, label, options, index=0, **kwargs): return self._valore(label, options[index])
+    def radio(self, label, options, index=0, **kwargs): return self._valore(label, options[index])
+    def slider(self, label, min_value=None, max_value=None, value=None, **kwargs): return self._valore(label, value)
+    def select_slider(self, label, options=(), value=None, **kwargs): return self._valore(label, value)
+    def checkbox(self, label, value=False, **kwargs): return self._valore(label, value)
+    def date_input(self, label, value=None, **kwargs): return self._valore(label, value)
+    def multiselect(self, label, options, default=None, **kwargs): return self._valore(label, list(default or []))
+    def button(self, label, **kwargs): return False
+    def expander(self, *args, **kwargs): return contextlib.nullcontext()
+    def stop(self): raise self.Stop()
+    def plotly_chart(self, figure, **kwargs): self.output_bytes += len(pio.to_json(figure, validate=False).encode("utf-8"))
+    def iframe(self, src, **kwargs): self.output_bytes += len(src.encode("utf-8"))
+
+
+@contextlib.contextmanager
+def stubbed_streamlit(stub):
+    # Solo i riferimenti usati dalle viste: i decoratori di cache restano quelli veri (MemoryCacheStorageManager)
+    originali = app.st
+    app.st = stub
+    try:
+        yield stub
+    finally:
+        app.st = originali
+
+
+def clear_app_caches():
+    for funzione in (app.get_map_cache, app.get_station_figures, app.get_rain_surface):
+        funzione.clear()
+
+
+def measure_step(esegui, prepara=None):
+    """Tempo a freddo, tempo a caldo (stesse cache) e picco di memoria (tracemalloc, in un'esecuzione separata)."""
+    if prepara: prepara()
+    inizio = time.perf_counter(); risultato = esegui(); freddo = time.perf_counter() - inizio
+    inizio = time.perf_counter(); esegui(); caldo = time.perf_counter() - inizio
+    if prepara: prepara()
+    tracemalloc.start()
+    try:
+        esegui(); _, picco = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return risultato, {"freddo_s": freddo, "caldo_s": caldo, "picco_mb": picco / 2**20}
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+
+
+def benchmark_app(n_stazioni, n_giorni, cartella, giorni_periodo=30):
+    percorso = write_sheet_csv(os.path.join(cartella, f"foglio_{n_stazioni}x{n_giorni}.csv"), n_stazioni, n_giorni)
+    app.SNAPSHOT_DIR = os.path.join(cartella, f"snapshot_{n_stazioni}x{n_giorni}")
+    risultati = {}
+
+    def svuota_snapshot():
+        for nome in os.listdir(app.SNAPSHOT_DIR) if os.path.isdir(app.SNAPSHOT_DIR) else []:
+            os.remove(os.path.join(app.SNAPSHOT_DIR, nome))
+
+    def carica():
+        df, meta = app.load_and_prepare_data(percorso)
+        return df, meta["sha256"]
+
+    with stubbed_streamlit(StreamlitStub()):
+        # Parsing completo del CSV, poi ripartenza con lo snapshot Parquet già scritto e la sorgente invariata
+        (df, versione), risultati["caricamento"] = measure_step(carica, svuota_snapshot)
+        _, risultati["caricamento_snapshot"] = measure_step(carica)
+        _, risultati["indice"] = measure_step(lambda: app.DataIndex(df, versione))
+    indice = app.DataIndex(df, versione)
+    fine = indice.ultima_data.date()
+
+    viste = {
+        "mappa_riepilogo": (lambda: app.display_main_map(indice, "benchmark"), {}),
+        "analisi_periodo": (lambda: app.display_period_analysis(indice), {"Seleziona un periodo:": (fine - timedelta(days=giorni_periodo - 1), fine)}),
+        "analisi_periodo_idw": (lambda: app.display_period_analysis(indice), {"Seleziona un periodo:": (fine - timedelta(days=giorni_periodo - 1), fine),
+                                                                             "Superficie di pioggia interpolata (IDW)": True, "Celle per lato della griglia": 300}),
+        "dettaglio_stazione": (lambda: app.display_station_detail(indice, str(indice.codici_stazioni[0])), {}),
+    }
+    for nome, (vista, valori) in viste.items():
+        stub = StreamlitStub(valori)
+        def prepara():
+            # Indice nuovo (proprietà cached_property da ricalcolare) e cache delle mappe e dei grafici vuote
+            app.get_map_cache.clear(); app.get_station_figures.clear(); app.get_rain_surface.clear()
+            for nome, attributo in vars(app.DataIndex).items():
+                if isinstance(attributo, cached_property): vars(indice).pop(nome, None)
+            stub.output_bytes = 0
+        with stubbed_streamlit(stub):
+            _, risultati[nome] = measure_step(vista, prepara)
+        risultati[nome]["output_kb"] = stub.output_bytes / 1024
+    return {"righe": len(df), "csv_mb": os.path.getsize(percorso) / 2**20, "fasi": risultati}
+
+
+def append_results(path, righe):
+    nuovo = not os.path.exists(path)
+    with open(path, "a", encoding="utf-8", newline="") as f:
+        scrittore = csv.DictWriter(f, fieldnames=["data", "commit", "stazioni", "giorni", "righe", "fase", "freddo_s", "caldo_s", "picco_mb", "output_kb"])
+        if nuovo: scrittore.writeheader()
+        scrittore.writerows(righe)
+
+
+def main_mappe(args):
+    print(f"{'vista':<10} {'stazioni':>9} {'modalità':<10} {'costruz. (s)':>13} {'render (s)':>11} {'HTML (KB)':>11}")
+    for n in args.stazioni:
+        for vista in args.vista:
+            if vista == "riepilogo":
+                df_mappa = synthetic_latest_snapshot(n)
+                costruttori = {nome: (lambda leggero=leggero, cluster=cluster: app.build_main_map(df_mappa, "OpenStreetMap", leggero=leggero, cluster=cluster))
+                               for nome, leggero, cluster in [("classico", False, False), ("leggero", True, False), ("cluster", True, True)]}
+            else:
+                df_agg = synthetic_period_aggregate(n)
+                costruttori = {nome: (lambda leggero=leggero: app.build_period_map(df_agg, "OpenStreetMap", [43.8, 11.0], leggero=leggero))
+                               for nome, leggero in [("classico", False), ("leggero", True)] if leggero or n <= args.max_classico_periodo}
+            for nome, costruisci in costruttori.items():
+                r = measure_map(costruisci)
+                print(f"{vista:<10} {n:>9} {nome:<10} {r['costruzione_s']:>13.3f} {r['totale_s']:>11.3f} {r['html_kb']:>11.0f}")
+
+
+def main_app(args):
+    # Fuori dal runtime Streamlit ogni accesso alle cache avvisa che manca lo ScriptRunContext
+    streamlit.logger.set_log_level("error")
+    commit, adesso = git_commit(), datetime.now().isoformat(timespec="seconds")
+    print(f"{'stazioni':>9} {'giorni':>7} {'righe':>9} {'fase':<22} {'freddo (s)':>11} {'caldo (s)':>10} {'picco (MB)':>11} {'output (KB)':>12}")
+    with tempfile.TemporaryDirectory(prefix="benchmark_mappa_") as cartella:
+        for n_stazioni in args.stazioni:
+            for n_giorni in args.giorni:
+                esito = benchmark_app(n_stazioni, n_giorni, cartella, args.giorni_periodo)
+                righe = []
+                for fase, misure in esito["fasi"].items():
+                    righe.append({"data": adesso, "commit": commit, "stazioni": n_stazioni, "giorni": n_giorni, "righe": esito["righe"], "fase": fase,
+                                  "freddo_s": f"{misure['freddo_s']:.4f}", "caldo_s": f"{misure['caldo_s']:.4f}", "picco_mb": f"{misure['picco_mb']:.1f}", "output_kb": f"{misure.get('output_kb', 0):.1f}"})
+                    print(f"{n_stazioni:>9} {n_giorni:>7} {esito['righe']:>9} {fase:<22} {misure['freddo_s']:>11.3f} {misure['caldo_s']:>10.3f} {misure['picco_mb']:>11.1f} {misure.get('output_kb', 0):>12.0f}")
+                append_results(args.risultati, righe)
+    print(f"Risultati accodati a {args.risultati}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    comandi = parser.add_subparsers(dest="comando", required=True)
+    mappe = comandi.add_parser("mappe", help="HTML e tempo di render delle mappe, classico contro leggero")
+    mappe.add_argument("--vista", nargs="+", choices=["riepilogo", "periodo"], default=["riepilogo", "periodo"])
+    mappe.add_argument("--stazioni", type=int, nargs="+", default=[100, 1000, 10000])
+    mappe.add_argument("--max-classico-periodo", type=int, default=1000, help="oltre questa soglia il rendering Plotly per stazione viene saltato (minuti di attesa)")
+    mappe.set_defaults(esegui=main_mappe)
+    completo = comandi.add_parser("app", help="caricamento e viste su un CSV sintetico stazioni x giorni")
+    completo.add_argument("--stazioni", type=int, nargs="+", default=[100, 1000])
+    completo.add_argument("--giorni", type=int, nargs="+", default=[365])
+    completo.add_argument("--giorni-periodo", type=int, default=30, help="ampiezza dell'intervallo nell'analisi di periodo")
+    completo.add_argument("--risultati", default="benchmark_risultati.csv", help="file CSV a cui accodare le misure")
+    completo.set_defaults(esegui=main_app)
+    args = parser.parse_args()
+    args.esegui(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,259 @@
+import os
+from datetime import date
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import app
+
+COLONNE_NUMERICHE = ['TOTALE_PIOGGIA_GIORNO', 'LATITUDINE', 'LONGITUDINE', 'MEDIA_TEMP_MAX', 'MEDIA_TEMP_MIN', 'MEDIA_TEMP_MEDIANA']
+
+
+def make_frame():
+    # Piccolo foglio con i casi limite dell'analisi di periodo
+    generatore = np.random.default_rng(0)
+    giorni = pd.date_range('2024-01-01', '2024-12-31', freq='D')
+    righe = []
+    for i, codice in enumerate(['A01', 'B02', 'C03', 'D04']):
+        for giorno in giorni:
+            righe.append({'CODICE': codice, 'STAZIONE': f'Stazione {codice}', 'DATA': giorno, 'LATITUDINE': 43.0 + i / 10, 'LONGITUDINE': 11.0 + i / 10,
+                          'TOTALE_PIOGGIA_GIORNO': generatore.gamma(0.5, 4.0), 'TEMP_MAX': generatore.normal(20, 5),
+                          'TEMP_MIN': generatore.normal(8, 4), 'TEMPERATURA_MEDIANA': generatore.normal(14, 4)})
+    # Stazione con righe solo a gennaio: assente dai periodi successivi
+    for giorno in giorni[:31]:
+        righe.append({'CODICE': 'E05', 'STAZIONE': 'Stazione E05', 'DATA': giorno, 'LATITUDINE': 44.0, 'LONGITUDINE': 10.0,
+                      'TOTALE_PIOGGIA_GIORNO': 1.0, 'TEMP_MAX': 5.0, 'TEMP_MIN': -1.0, 'TEMPERATURA_MEDIANA': 2.0})
+    df = pd.DataFrame(righe)
+    df['CODICE'] = df['CODICE'].astype('category')
+    for col in ['TOTALE_PIOGGIA_GIORNO', 'TEMP_MAX', 'TEMP_MIN', 'TEMPERATURA_MEDIANA', 'LATITUDINE', 'LONGITUDINE']:
+        df[col] = df[col].astype(app.TIPO_NUMERICO)
+
+    # Stazione senza nessuna misura: pioggia 0 e medie NaN
+    df.loc[df['CODICE'] == 'C03', ['TOTALE_PIOGGIA_GIORNO', 'TEMP_MAX', 'TEMP_MIN', 'TEMPERATURA_MEDIANA']] = np.nan
+    # NaN sparsi: TEMP_MAX e TEMP_MIN con gli stessi buchi (conteggi condivisi), TEMPERATURA_MEDIANA con buchi propri
+    buchi = generatore.random(len(df)) < 0.1
+    df.loc[buchi, ['TEMP_MAX', 'TEMP_MIN']] = np.nan
+    df.loc[generatore.random(len(df)) < 0.05, 'TEMPERATURA_MEDIANA'] = np.nan
+    df.loc[generatore.random(len(df)) < 0.05, 'TOTALE_PIOGGIA_GIORNO'] = np.nan
+    # Date e codici mancanti: righe escluse dall'aggregazione
+    df.loc[[3, 400, 800], 'DATA'] = pd.NaT
+    df.loc[[10, 500], 'CODICE'] = np.nan
+    return df
+
+
+def groupby_aggregate(df, start_date, end_date):
+    # Aggregazione originale dell'analisi di periodo, usata come riferimento
+    df_with_dates = df.dropna(subset=['DATA', 'CODICE'])
+    df_filtered = df_with_dates[df_with_dates['DATA'].dt.date.between(start_date, end_date)]
+    agg_cols = {'STAZIONE': 'first', 'TOTALE_PIOGGIA_GIORNO': 'sum', 'LATITUDINE': 'first', 'LONGITUDINE': 'first', 'TEMP_MAX': 'mean', 'TEMP_MIN': 'mean', 'TEMPERATURA_MEDIANA': 'mean'}
+    df_agg = df_filtered.groupby('CODICE', observed=True).agg(agg_cols).reset_index().dropna(subset=['LATITUDINE', 'LONGITUDINE'])
+    df_agg.rename(columns={'TEMP_MAX': 'MEDIA_TEMP_MAX', 'TEMP_MIN': 'MEDIA_TEMP_MIN', 'TEMPERATURA_MEDIANA': 'MEDIA_TEMP_MEDIANA'}, inplace=True)
+    return df_agg.reset_index(drop=True)
+
+
+@pytest.fixture(scope='module')
+def frame():
+    return make_frame()
+
+
+@pytest.fixture(scope='module')
+def indice(frame):
+    return app.DataIndex(frame)
+
+
+@pytest.mark.parametrize('start_date, end_date', [
+    (date(2024, 3, 15), date(2024, 3, 15)),   # un solo giorno
+    (date(2024, 2, 10), date(2024, 6, 20)),   # più mesi, E05 senza righe nel periodo
+    (date(2023, 1, 1), date(2025, 1, 1)),     # tutto lo storico
+    (date(2026, 1, 1), date(2026, 2, 1)),     # nessuna riga
+])
+def test_period_cube_matches_groupby(frame, indice, start_date, end_date):
+    atteso = groupby_aggregate(frame, start_date, end_date)
+    ottenuto = indice.cubo.aggregate(start_date, end_date).dropna(subset=['LATITUDINE', 'LONGITUDINE']).reset_index(drop=True)
+    assert list(ottenuto.columns) == list(atteso.columns)
+    assert list(ottenuto['CODICE'].astype(str)) == list(atteso['CODICE'].astype(str))
+    assert list(ottenuto['STAZIONE'].astype(str)) == list(atteso['STAZIONE'].astype(str))
+    for col in COLONNE_NUMERICHE:
+        np.testing.assert_allclose(ottenuto[col].to_numpy(np.float64), atteso[col].to_numpy(np.float64), rtol=1e-5, equal_nan=True, err_msg=col)
+
+
+def test_period_cube_edge_stations(indice):
+    df_agg = indice.cubo.aggregate(date(2024, 2, 10), date(2024, 6, 20)).set_index('CODICE')
+    assert 'E05' not in df_agg.index
+    assert df_agg.loc['C03', 'TOTALE_PIOGGIA_GIORNO'] == 0
+    assert df_agg.loc['C03', ['MEDIA_TEMP_MAX', 'MEDIA_TEMP_MIN', 'MEDIA_TEMP_MEDIANA']].isna().all()
+    assert indice.cubo.aggregate(date(2026, 1, 1), date(2026, 2, 1)).empty
+
+
+def test_period_cube_shares_counts(indice):
+    cubo = indice.cubo
+    # Conteggi condivisi tra colonne con gli stessi NaN
+    assert cubo.conteggi['TEMP_MAX'] is cubo.conteggi['TEMP_MIN']
+    assert cubo.conteggi['TEMPERATURA_MEDIANA'] is not cubo.conteggi['TEMP_MAX']
+    assert cubo.conteggi['TOTALE_PIOGGIA_GIORNO'] is not cubo.conteggi['TEMPERATURA_MEDIANA']
+    n_celle = cubo.righe.size
+    assert cubo.nbytes == n_celle * (8 * len(cubo.somme) + 4 * 4)
+
+
+def test_period_cube_unmeasured_rain(indice):
+    # C03 ha righe ma nessuna pioggia valida: per la superficie IDW è un NaN, non un punto a 0 mm
+    df_agg = indice.cubo.aggregate(date(2024, 2, 10), date(2024, 6, 20), solo_misurate=True).set_index('CODICE')
+    assert np.isnan(df_agg.loc['C03', 'TOTALE_PIOGGIA_GIORNO'])
+    assert df_agg.drop(index='C03')['TOTALE_PIOGGIA_GIORNO'].notna().all()
+    superficie = app.idw_surface(df_agg['LATITUDINE'], df_agg['LONGITUDINE'], df_agg['TOTALE_PIOGGIA_GIORNO'], n_celle=100)
+    atteso = app.idw_surface(df_agg['LATITUDINE'].drop('C03'), df_agg['LONGITUDINE'].drop('C03'), df_agg['TOTALE_PIOGGIA_GIORNO'].drop('C03'), n_celle=100)
+    np.testing.assert_array_equal(superficie[0], atteso[0])
+
+
+def test_map_cache_bounded_by_bytes():
+    cache = app.MapHtmlCache(max_voci=10, max_byte=250)
+    for stato in range(3):
+        cache.get_or_build(1, stato, lambda: 'x' * 100)
+    # La terza mappa fa superare il limite: esce la meno recente
+    assert cache.stats()['voci'] == 2 and cache.stats()['byte'] == 200
+    costruite = []
+    cache.get_or_build(1, 0, lambda: costruite.append(0) or 'x' * 100)
+    assert costruite == [0]
+    # Più grande dell'intero limite: restituita ma non conservata
+    assert cache.get_or_build(1, 'grande', lambda: 'y' * 300) == 'y' * 300
+    assert cache.stats()['byte'] == 200
+    # Nuova versione dei dati: cache svuotata
+    cache.get_or_build(2, 0, lambda: 'z' * 10)
+    assert cache.stats()['voci'] == 1 and cache.stats()['byte'] == 10
+
+
+@pytest.fixture(scope='module')
+def spaziale():
+    generatore = np.random.default_rng(1)
+    lat, lon = generatore.uniform(42.0, 45.0, 500), generatore.uniform(9.5, 12.5, 500)
+    # Alcune stazioni coincidenti e una sul bordo di una cella della griglia
+    lat[:3], lon[:3] = 43.5, 11.0
+    lat[3], lon[3] = 172 * app.PASSO_GRIGLIA, 44 * app.PASSO_GRIGLIA
+    return app.SpatialIndex(lat, lon)
+
+
+@pytest.mark.parametrize('sud, ovest, nord, est', [
+    (43.0, 10.0, 44.0, 11.5),   # stazione 3 sul bordo sud del riquadro
+    (43.5, 11.0, 43.5, 11.0),   # riquadro degenere sulle stazioni coincidenti
+    (40.0, 5.0, 41.0, 6.0),     # nessuna stazione
+    (41.0, 9.0, 46.0, 13.0),    # tutte
+])
+def test_spatial_index_in_bbox(spaziale, sud, ovest, nord, est):
+    attese = np.flatnonzero((spaziale.lat >= sud) & (spaziale.lat <= nord) & (spaziale.lon >= ovest) & (spaziale.lon <= est))
+    np.testing.assert_array_equal(spaziale.in_bbox(sud, ovest, nord, est), attese)
+
+
+@pytest.mark.parametrize('lat, lon, n', [(43.5, 11.0, 5), (42.1, 9.6, 1), (46.5, 14.0, 10), (43.0, 11.0, 600)])
+def test_spatial_index_nearest(spaziale, lat, lon, n):
+    distanze_tutte = app.haversine_km(lat, lon, spaziale.lat, spaziale.lon)
+    posizioni, distanze = spaziale.nearest(lat, lon, n)
+    assert len(posizioni) == min(n, len(spaziale))
+    np.testing.assert_allclose(distanze, np.sort(distanze_tutte)[:len(posizioni)])
+    np.testing.assert_allclose(distanze_tutte[posizioni], distanze)
+
+
+INTESTAZIONE_FOGLIO = 'Codice,Stazione,Data,Latitudine,Longitudine,Totale Pioggia Giorno,Temp Max,[Legenda] Colore\nx,x,x,x,x,x,x,x\n'
+
+
+def sheet_rows(codici, giorno_iniziale=1, colore='VERDE'):
+    return ''.join(f'{codice},Stazione {codice},{giorno:02d}/01/2024,"43,{i}","11,{i}","{giorno},5","2{i},0",{colore}\n'
+                   for giorno in range(giorno_iniziale, giorno_iniziale + 5) for i, codice in enumerate(codici))
+
+
+@pytest.fixture
+def sorgente(tmp_path, monkeypatch):
+    monkeypatch.setattr(app, 'SNAPSHOT_DIR', str(tmp_path / 'snapshot'))
+    percorso = tmp_path / 'foglio.csv'
+
+    def scrivi(testo):
+        percorso.write_text(testo, encoding='utf-8')
+        # Il validatore dei file locali è mtime+dimensione: lo si cambia anche per riscritture rapide
+        stat = os.stat(percorso); os.utime(percorso, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+        return str(percorso)
+    return scrivi
+
+
+def full_parse(percorso):
+    with open(percorso, 'rb') as f:
+        return app.prepare_dataframe(app.read_sheet_csv(f.read()))
+
+
+def assert_same_frame(df, atteso):
+    pd.testing.assert_frame_equal(df.reset_index(drop=True), atteso.reset_index(drop=True), check_categorical=False, check_dtype=False)
+
+
+def test_load_unchanged_source_uses_snapshot(sorgente):
+    url = sorgente(INTESTAZIONE_FOGLIO + sheet_rows(['A', 'B']))
+    df, meta = app.load_incremental(url)
+    assert meta['modalita'] == 'completo'
+    df_snapshot, meta = app.load_incremental(url)
+    assert meta['modalita'] == 'snapshot'
+    assert_same_frame(df_snapshot, df)
+
+
+def test_load_grown_source_parses_tail(sorgente):
+    testo = INTESTAZIONE_FOGLIO + sheet_rows(['A', 'B'])
+    app.load_incremental(sorgente(testo))
+    url = sorgente(testo + sheet_rows(['A', 'B', 'C'], giorno_iniziale=6))
+    df, meta = app.load_incremental(url)
+    assert meta['modalita'] == 'incrementale' and meta['righe'] == 25
+    assert_same_frame(df, full_parse(url))
+
+
+def test_load_rewritten_source_parses_everything(sorgente):
+    testo = INTESTAZIONE_FOGLIO + sheet_rows(['A', 'B'])
+    app.load_incremental(sorgente(testo))
+    url = sorgente(testo.replace('Stazione B', 'Stazione Bis') + sheet_rows(['A'], giorno_iniziale=6))
+    df, meta = app.load_incremental(url)
+    assert meta['modalita'] == 'completo'
+    assert_same_frame(df, full_parse(url))
+
+
+def test_load_tail_with_empty_category_column(sorgente):
+    testo = INTESTAZIONE_FOGLIO + sheet_rows(['A', 'B'])
+    app.load_incremental(sorgente(testo))
+    # Righe nuove con il colore non ancora compilato: la categoria della coda è tutta vuota
+    url = sorgente(testo + sheet_rows(['A'], giorno_iniziale=6, colore=''))
+    df, meta = app.load_incremental(url)
+    assert meta['modalita'] == 'incrementale'
+    assert_same_frame(df, full_parse(url))
+    assert df['LEGENDA_COLORE'].isna().sum() == 5
+
+
+def test_load_falls_back_to_full_parse(sorgente, monkeypatch):
+    testo = INTESTAZIONE_FOGLIO + sheet_rows(['A', 'B'])
+    app.load_incremental(sorgente(testo))
+    url = sorgente(testo + sheet_rows(['A'], giorno_iniziale=6))
+
+    def rotto(df_a, df_b): raise TypeError('coda non unibile')
+    monkeypatch.setattr(app, 'concat_frames', rotto)
+    df, meta = app.load_incremental(url)
+    assert meta['modalita'] == 'completo'
+    assert_same_frame(df, full_parse(url))
+
+
+def test_refresher_serves_snapshot_before_first_fetch(sorgente, monkeypatch):
+    url = sorgente(INTESTAZIONE_FOGLIO + sheet_rows(['A', 'B']))
+    _, meta = app.load_incremental(url)
+
+    def irraggiungibile(url, metriche=None): raise OSError('rete assente')
+    monkeypatch.setattr(app, 'load_and_prepare_data', irraggiungibile)
+    aggiornamento = app.DataRefresher(url)
+    # Nessun thread avviato: la versione servita arriva dallo snapshot, senza attendere la sorgente
+    servita = aggiornamento.current()
+    assert servita.versione == meta['sha256'] and len(servita.indice.df_ordinato) == 10
+    # Un aggiornamento fallito lascia in servizio lo snapshot
+    assert not aggiornamento.refresh()
+    assert aggiornamento.current() is servita and aggiornamento.errore == 'rete assente'
+
+
+def test_refresher_without_snapshot_waits_for_source(sorgente):
+    url = sorgente(INTESTAZIONE_FOGLIO + sheet_rows(['A', 'B']))
+    aggiornamento = app.DataRefresher(url, intervallo=3600)
+    assert aggiornamento.servita is None
+    try:
+        servita = aggiornamento.start().current()
+    finally:
+        aggiornamento.stop()
+    assert servita is not None and len(servita.indice.df_ordinato) == 10